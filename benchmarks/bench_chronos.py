@@ -0,0 +1,43 @@
+import random
+import timeit
+
+from gcd.chronos import utc, utc_many, iso, iso_many, trunc, trunc_many
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+def main(n=100000, repeat=3):
+    now = utc(2020, 1, 1)
+    stamps = [now + random.uniform(0, 365 * 86400) for _ in range(n)]
+    for name, layout in ("datetime", iso), ("date", lambda ts: iso(ts)[:10]):
+        isos = [layout(ts) for ts in stamps]
+        benchs = {
+            "utc loop": lambda: [utc(i) for i in isos],
+            "utc_many": lambda: utc_many(isos),
+        }
+        if numpy:
+            array = numpy.array(isos)
+            benchs["utc_many numpy"] = lambda: utc_many(array)
+        for bench, fun in benchs.items():
+            secs = min(timeit.repeat(fun, number=1, repeat=repeat))
+            print("%-10s %-16s %8.1f ns/item" % (name, bench, secs / n * 1e9))
+    benchs = {
+        "iso loop": lambda: [iso(ts) for ts in stamps],
+        "iso_many": lambda: iso_many(stamps),
+        "trunc loop": lambda: [trunc(ts, 3600) for ts in stamps],
+        "trunc_many": lambda: trunc_many(stamps, 3600),
+    }
+    if numpy:
+        array = numpy.array(stamps)
+        benchs["iso_many numpy"] = lambda: iso_many(array)
+        benchs["trunc_many numpy"] = lambda: trunc_many(array, 3600)
+    for bench, fun in benchs.items():
+        secs = min(timeit.repeat(fun, number=1, repeat=repeat))
+        print("%-10s %-16s %8.1f ns/item" % ("stamp", bench, secs / n * 1e9))
+
+
+if __name__ == "__main__":
+    main()
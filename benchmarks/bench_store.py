@@ -0,0 +1,116 @@
+import os
+import sys
+import json
+import timeit
+
+from itertools import islice
+
+import psycopg2
+
+from gcd.nix import sh
+from gcd.monitor import Monitor
+from gcd.store import Transaction, QueryProfiler, execute, executemany, copy_rows
+from gcd.store import query_presto_cli, named, columns
+
+
+class NopCursor:  # To measure what execute adds to a query.
+    name = None
+    rowcount = 1
+
+    def __init__(self):
+        self.connection = self  # Anything weak referenceable.
+
+    def execute(self, sql, args):
+        pass
+
+
+class RowsCursor:  # To measure how fetched rows are gathered.
+    itersize = 2000
+    description = [("i", 23), ("x", 701), ("s", 25), ("j", 25)]
+
+    def __init__(self, rows):
+        self._rows = iter(rows)
+
+    def fetchmany(self, size):
+        return list(islice(self._rows, size))
+
+
+def rows(n):
+    return ((i, i * 0.5, "row %s" % i, '{"i": %s}' % i) for i in range(n))
+
+
+def insert(conn, how, n):
+    with Transaction(conn):
+        execute("TRUNCATE bench")
+        if how == "executemany":
+            executemany("INSERT INTO bench VALUES (%s, %s, %s, %s)", list(rows(n)))
+        elif how == "values":
+            execute("INSERT INTO bench VALUES %s", rows(n), values=True)
+        else:
+            copy_rows("bench", ("i", "x", "s", "j"), rows(n))
+
+
+def profiling(n, repeat):
+    cursor = NopCursor()
+    sql = "SELECT * FROM bench WHERE i = %s AND s = 'x'"
+    for sample in None, 0, 0.01, 1:
+        if sample is None:
+            QueryProfiler.uninstall()
+        else:
+            QueryProfiler.install(Monitor(), sample=sample)
+        fun = lambda: [execute(sql, (i,), cursor) for i in range(n)]  # noqa: E731
+        secs = min(timeit.repeat(fun, number=1, repeat=repeat))
+        print("profile sample %-6s %8.1f ns/query" % (sample, secs / n * 1e9))
+    QueryProfiler.uninstall()
+
+
+def gathering(how, n):
+    cursor = RowsCursor(rows(n))
+    if how == "named":  # Rows to columns by hand.
+        bundles = list(named(cursor))
+        return {d[0]: [b[d[0]] for b in bundles] for d in cursor.description}
+    return columns(cursor, numpy=how == "numpy")
+
+
+presto_cli = "%s %s" % (
+    sys.executable,
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "fake_presto_cli.py"),
+)
+
+
+def presto(how, n):
+    query = "SELECT * FROM bench WHERE {partition} LIMIT %s" % n
+    if how == "lines":  # What query_presto_cli used to do.
+        proc = sh("exec %s --file /dev/stdin |&" % presto_cli, query)
+        rows = list(map(json.loads, proc.stdout))
+        proc.wait()
+    elif how == "partitions":
+        parts = ["i %% 4 = %s" % i for i in range(4)]
+        rows = list(query_presto_cli(query, presto_cli, partitions=parts))
+    else:
+        rows = list(query_presto_cli(query, presto_cli, prefetch=how == "prefetch"))
+    assert len(rows) == (4 * n if how == "partitions" else n)
+
+
+def main(dbname=None, n=100000, repeat=3):  # Other settings come from PG* vars.
+    profiling(n, repeat)
+    for how in "named", "columns", "numpy":
+        secs = min(timeit.repeat(lambda: gathering(how, n), number=1, repeat=repeat))
+        print("gather %-13s %8.1f us/row" % (how, secs / n * 1e6))
+    for how in "lines", "chunks", "prefetch", "partitions":
+        secs = min(timeit.repeat(lambda: presto(how, n), number=1, repeat=repeat))
+        rows = 4 * n if how == "partitions" else n
+        print("presto %-13s %8.1f us/row" % (how, secs / rows * 1e6))
+    if not dbname:
+        return
+    conn = psycopg2.connect(dbname=dbname)
+    with Transaction(conn):
+        execute("CREATE TEMP TABLE bench (i int, x float8, s text, j text)")
+    for how in "executemany", "values", "copy_rows":
+        secs = min(timeit.repeat(lambda: insert(conn, how, n), number=1, repeat=repeat))
+        print("%-20s %8.1f us/row" % (how, secs / n * 1e6))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:2])
@@ -0,0 +1,48 @@
+import timeit
+import queue
+import multiprocessing as mp
+
+from gcd.work import SharedQueue, packer, unpacker
+
+
+def old_unpacker(get):  # What unpacker used to be, for comparison.
+    def wrapper():
+        nonlocal pack
+        if not pack:
+            pack = get()
+        return pack.pop(0)
+
+    pack = None
+    return wrapper
+
+
+def roundtrip(q, n, size, typecode=None, unpacker=unpacker):
+    put = packer(q.put, size, typecode)
+    get = unpacker(q.get, typecode) if typecode else unpacker(q.get)
+    for _ in range(0, n, size):
+        for x in range(size):
+            put(x * 0.5)
+        for _ in range(size):
+            get()
+
+
+def main(n=100000, size=10000, repeat=3):
+    benchs = {
+        "old unpacker queue": lambda: roundtrip(
+            queue.Queue(), n, size, unpacker=old_unpacker
+        ),
+        "queue": lambda: roundtrip(queue.Queue(), n, size),
+        "queue array": lambda: roundtrip(queue.Queue(), n, size, "d"),
+        "mp queue": lambda: roundtrip(mp.Queue(), n, size),
+        "mp queue array": lambda: roundtrip(mp.Queue(), n, size, "d"),
+    }
+    shared = SharedQueue()
+    benchs["shared queue array"] = lambda: roundtrip(shared, n, size, "d")
+    for bench, fun in benchs.items():
+        secs = min(timeit.repeat(fun, number=1, repeat=repeat))
+        print("%-20s %8.1f ns/item" % (bench, secs / n * 1e9))
+    shared.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,29 @@
+#!/usr/bin/env python3
+# Stands for presto-cli in benchmarks: prints as many JSON rows as the LIMIT of
+# the query read from stdin (or --file), ignoring anything else but SLEEP seconds
+# to wait for after the first row.
+import re
+import sys
+import time
+
+
+def main(args):
+    path = args[args.index("--file") + 1] if "--file" in args else "/dev/stdin"
+    with open(path) as file:
+        query = file.read()
+    if "FAIL" in query:
+        print("Query failed: FAIL", file=sys.stderr)
+        return 1
+    limit = re.search(r"\bLIMIT\s+(\d+)", query, re.I)
+    sleep = re.search(r"\bSLEEP\s+([\d.]+)", query, re.I)
+    line = '{"i": %s, "x": %s, "s": "row %s"}\n'
+    for i in range(int(limit.group(1)) if limit else 1000):
+        sys.stdout.write(line % (i, i * 0.5, i))
+        if sleep and i == 0:
+            sys.stdout.flush()
+            time.sleep(float(sleep.group(1)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
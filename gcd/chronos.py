@@ -1,31 +1,48 @@
 import os
+import re
+import math
 import time
+import asyncio
+import threading as mt
+import multiprocessing as mp
 
-from datetime import datetime, timedelta
+from array import array
+from itertools import repeat
+from datetime import date, datetime, timedelta
+
+from gcd.etc import PositionalAttribute
 
 
 def utc(*args, **kwargs):
     if args and type(args[0]) is str:
-        iso = args[0].replace("T", " ").rstrip("Z")
-        formats = (
-            "%Y-%m-%d %H:%M:%S.%f",
-            "%Y-%m-%d %H:%M:%S",
-            "%Y-%m-%d",
-            "%H:%M:%S.%f",
-            "%H:%M:%S",
-        )
-        for format in formats:
-            try:
-                return strptime(iso, format)
-            except ValueError:
-                if format is formats[-1]:
-                    raise
+        try:
+            stamp = _fast_utc(args[0], _local_offsets())
+        except ValueError:
+            stamp = None
+        return _slow_utc(args[0]) if stamp is None else stamp
     else:
         return datetime(*args, **kwargs).timestamp()
 
 
+def utc_many(isos):
+    if _is_numpy(isos):
+        return _utc_many_numpy(isos)
+    offsets = _local_offsets()
+    stamps = array("d")
+    parse = None
+    for iso in isos:
+        if parse is None:  # Detect the format of the column from its first item.
+            parse = _fast_utc if _iso_regex.fullmatch(iso) else _strptime_utc(iso)
+        try:
+            stamp = parse(iso, offsets)
+        except ValueError:
+            stamp = None
+        stamps.append(utc(iso) if stamp is None else stamp)
+    return stamps
+
+
 def iso(ts):
-    return strftime(ts, "%Y-%m-%d %H:%M:%S.%f")
+    return strftime(ts, _iso_format)
 
 
 def strptime(str, format):
@@ -36,6 +53,37 @@ def strftime(ts, format):
     return datetime.fromtimestamp(ts).strftime(format)
 
 
+def iso_many(stamps, out=None):
+    if _is_numpy(stamps):
+        return _iso_many_numpy(stamps, out)
+    return strftime_many(stamps, _iso_format, out)
+
+
+def strftime_many(stamps, format, out=None):
+    if _is_numpy(stamps):
+        if format == _iso_format:
+            return _iso_many_numpy(stamps, out)
+        stamps = stamps.tolist()
+    out = [None] * len(stamps) if out is None else out
+    for i, stamp in enumerate(stamps):
+        local = datetime.fromtimestamp(stamp)
+        if format is _iso_format and local.year >= 1000:  # Same but faster.
+            out[i] = local.isoformat(" ", "microseconds")
+        else:
+            out[i] = local.strftime(format)
+    return out
+
+
+def local_many(stamps):
+    if _is_numpy(stamps):
+        import numpy as np
+
+        secs = np.floor(stamps)
+        return stamps + _utc_offsets_numpy(secs.astype(np.int64))
+    offsets = _local_offsets(utc=True)
+    return array("d", (s + _utc_offset(math.floor(s), offsets) for s in stamps))
+
+
 def span(*args, **kwargs):
     return timedelta(*args, **kwargs).total_seconds()
 
@@ -45,12 +93,23 @@ def trunc(ts, span):
     return trunc_ts if trunc_ts + span > ts else ts
 
 
+def trunc_many(stamps, span):
+    if _is_numpy(stamps):
+        import numpy as np
+
+        trunc_stamps = (stamps // span) * span
+        return np.where(trunc_stamps + span > stamps, trunc_stamps, stamps)
+    return array("d", map(trunc, stamps, repeat(span)))
+
+
 def set_timezone(timezone=None):
     if timezone:
         os.environ["TZ"] = timezone
     elif "TZ" in os.environ:
         del os.environ["TZ"]
     time.tzset()
+    _offsets.clear()
+    _utc_offsets.clear()
 
 
 def as_datetime(ts):
@@ -70,23 +129,31 @@ def as_timer(period_or_timer):
     if isinstance(period_or_timer, Timer):
         return period_or_timer
     else:
-        return Timer(period_or_timer)
+        return Timer(period_or_timer, monotonic=True)
 
 
 class Timer:
-    def __init__(self, period, start_at=None, align=False):
+    def __init__(self, period, start_at=None, align=False, monotonic=False):
         assert not (start_at and align)
         self.period = period
+        self.monotonic = monotonic
+        now = time.time()
         if start_at:
-            self._next_time = start_at
+            next_time = start_at
         else:
-            now = time.time()
             last_time = (int(now / period) * period) if align else now
-            self._next_time = last_time + period
+            next_time = last_time + period
+        if monotonic:  # Anchor the schedule to the monotonic clock just once.
+            next_time += time.monotonic() - now
+        self._next_time = next_time
+
+    @property
+    def next_time(self):
+        return self._next_time
 
     @property
     def is_time(self):
-        now = time.time()
+        now = self._now()
         if now >= self._next_time:
             while now >= self._next_time:
                 self._next_time += self.period
@@ -94,9 +161,16 @@ class Timer:
         else:
             return False
 
+    @property
+    def delay(self):
+        return max(0, self._next_time - self._now())
+
     def wait(self):
         while not self.is_time:
-            time.sleep(max(0, self._next_time - time.time()))
+            time.sleep(self.delay)
+
+    def _now(self):
+        return time.monotonic() if self.monotonic else time.time()
 
 
 class LeakyBucket:
@@ -105,24 +179,262 @@ class LeakyBucket:
         self._capacity = capacity
         self._used = 0
         self._last_leak = time.time()
+        self._lock = mt.Lock()
 
     def use(self):
-        if self._used == self._capacity:
-            leaked = int((time.time() - self._last_leak) / self._period)
-            if leaked == 0:
-                return False
-            self._last_leak += leaked * self._period
-            self._used = max(0, self._used - leaked)
-        self._used += 1
-        return True
+        with self._lock:
+            if self._used >= self._capacity:
+                # Reservations may have moved the last leak into the future.
+                leaked = int((time.time() - self._last_leak) / self._period)
+                if leaked <= 0:
+                    return False
+                self._last_leak += leaked * self._period
+                self._used = max(0, self._used - leaked)
+            self._used += 1
+            return True
 
     def wait(self, space=1):
+        delay = self._reserve(space, False)
+        if delay > 0:
+            time.sleep(delay)
+
+    async def acquire(self, space=1):
+        delay = self._reserve(space, True)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self._release(space)
+                raise
+
+    def _reserve(self, space, use):
         assert space <= self._capacity
-        to_leak = space - (self._capacity - self._used)
-        if to_leak > 0:
-            now = time.time()
-            until = to_leak * self._period + self._last_leak
-            if until > now:
-                time.sleep(until - now)
-            self._last_leak = until
-            self._used = max(0, self._used - to_leak)
+        with self._lock:
+            to_leak = space - (self._capacity - self._used)
+            until = now = time.time()
+            if to_leak > 0:
+                until = to_leak * self._period + self._last_leak
+                self._last_leak = until
+                self._used = max(0, self._used - to_leak)
+            if use:
+                self._used += space
+            return until - now
+
+    def _release(self, space):  # Gives back booked future leaks first.
+        with self._lock:
+            booked = math.ceil((self._last_leak - time.time()) / self._period)
+            booked = min(space, max(0, booked))
+            self._last_leak -= booked * self._period
+            self._used = max(0, self._used - (space - booked))
+
+
+class SharedLeakyBucket(LeakyBucket):  # Must be inherited by the processes.
+
+    PositionalAttribute.install(("_used", "_last_leak"), locals(), "_state")
+
+    def __init__(self, freq, capacity):
+        self._state = mp.RawArray("d", 2)
+        super().__init__(freq, capacity)
+        self._lock = mp.Lock()
+
+
+_iso_format = "%Y-%m-%d %H:%M:%S.%f"
+
+_formats = (
+    "%Y-%m-%d %H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%d",
+    "%H:%M:%S.%f",
+    "%H:%M:%S",
+)
+
+_local = mt.local()  # Remembers the last matching format, per thread.
+
+# Same ranges accepted by strptime for the common ISO layouts; anything else
+# (including invalid days) is left to strptime so errors are preserved.
+_iso_regex = re.compile(
+    r"(\d{4})-(1[0-2]|0[1-9]|[1-9])-(3[01]|[12]\d|0[1-9]|[1-9])"
+    r"(?:[T ](2[0-3]|[01]\d|\d):([0-5]\d|\d):([0-5]\d|\d)(?:\.(\d{1,6}))?)?Z*"
+)
+
+_epoch = datetime(1970, 1, 1)
+
+_epoch_ordinal = _epoch.toordinal()
+
+# Local offsets are cached per quarter of an hour (of local or UTC time), when
+# they're the same at both ends of it. Quarters with a zone transition inside
+# (like 00:01 in America/St_Johns until 2011) are computed item by item.
+_offset_span = 900
+
+_max_offsets = 100000
+
+_offsets = {}
+
+_unknown = object()
+
+_utc_offsets = {}
+
+_offsets_zone = None
+
+
+def _is_numpy(obj):
+    return type(obj).__module__ == "numpy"
+
+
+def _local_offsets(utc=False):
+    global _offsets_zone
+    zone = time.tzname, time.timezone, time.altzone
+    if zone != _offsets_zone:
+        _offsets.clear()
+        _utc_offsets.clear()
+        _offsets_zone = zone
+    return _utc_offsets if utc else _offsets
+
+
+def _local_offset(naive, offsets):  # None if there's a transition near naive.
+    return _span_offset(naive // _offset_span, offsets, _naive_offset)
+
+
+def _span_offset(span, offsets, offset_at):
+    offset = offsets.get(span, _unknown)
+    if offset is _unknown:
+        if len(offsets) >= _max_offsets:
+            offsets.clear()
+        start = span * _offset_span
+        offset = offset_at(start)
+        if offset != offset_at(start + _offset_span - 1):
+            offset = None
+        offsets[span] = offset
+    return offset
+
+
+def _naive_offset(naive):
+    return int((_epoch + timedelta(seconds=naive)).timestamp()) - naive
+
+
+def _utc_offset(stamp, offsets):
+    offset = _span_offset(stamp // _offset_span, offsets, _stamp_offset)
+    return _stamp_offset(stamp) if offset is None else offset
+
+
+def _stamp_offset(stamp):
+    return (datetime.fromtimestamp(stamp) - _epoch) // timedelta(seconds=1) - stamp
+
+
+def _fast_utc(iso, offsets):
+    match = _iso_regex.fullmatch(iso)
+    if not match:
+        return None
+    year, month, day, hour, minute, second, micro = match.groups()
+    naive = (date(int(year), int(month), int(day)).toordinal() - _epoch_ordinal) * 86400
+    if hour:
+        naive += int(hour) * 3600 + int(minute) * 60 + int(second)
+    offset = _local_offset(naive, offsets)
+    if offset is None:
+        return None
+    stamp = naive + offset
+    return stamp + int(micro.ljust(6, "0")) / 1e6 if micro else float(stamp)
+
+
+def _slow_utc(iso):
+    iso = iso.replace("T", " ").rstrip("Z")
+    last_format = getattr(_local, "format", None)
+    if last_format:
+        try:
+            return strptime(iso, last_format)
+        except ValueError:
+            pass
+    for format in _formats:
+        try:
+            stamp = strptime(iso, format)
+            _local.format = format
+            return stamp
+        except ValueError:
+            if format is _formats[-1]:
+                raise
+
+
+def _strptime_utc(sample):
+    sample = sample.replace("T", " ").rstrip("Z")
+    for format in _formats:
+        try:
+            strptime(sample, format)
+            break
+        except ValueError:
+            pass
+    else:
+        return lambda iso, offsets: None  # Let utc raise the proper error.
+    return lambda iso, offsets: strptime(iso.replace("T", " ").rstrip("Z"), format)
+
+
+_iso_templates = {
+    10: "0000-00-00",
+    19: "0000-00-00 00:00:00",
+    **{20 + n: "0000-00-00 00:00:00." + "0" * n for n in range(1, 7)},
+}
+
+_min_micros = (datetime(1, 1, 1) - _epoch) // timedelta(microseconds=1)
+
+
+def _utc_many_numpy(isos):
+    import numpy as np
+
+    isos = np.asarray(isos, str)
+    if not len(isos):
+        return np.array([], np.float64)
+    isos = np.char.rstrip(np.char.replace(isos, "T", " "), "Z")
+    template = _iso_templates.get(isos.dtype.itemsize // 4)
+    if template is None or np.any(np.char.str_len(isos) != len(template)):
+        return np.array(utc_many(isos.tolist()))
+    codes = np.ascontiguousarray(isos).view(np.uint32).reshape(-1, len(template))
+    tmpl_codes = np.array([ord(c) for c in template], np.uint32)
+    digits = tmpl_codes == ord("0")
+    valid = np.all(codes[:, digits] - ord("0") <= 9) and np.all(
+        codes[:, ~digits] == tmpl_codes[~digits]
+    )
+    try:
+        micros = isos.astype("datetime64[us]").astype(np.int64) if valid else None
+    except ValueError:
+        micros = None
+    if micros is None or micros.min() < _min_micros:
+        return np.array(utc_many(isos.tolist()))
+    naives, micros = np.divmod(micros, 1000000)
+    spans, inverse = np.unique(naives // _offset_span, return_inverse=True)
+    offsets = _local_offsets()
+    span_offsets = [_local_offset(int(s) * _offset_span, offsets) for s in spans]
+    if None in span_offsets:
+        return np.array(utc_many(isos.tolist()))
+    span_offsets = np.array(span_offsets, np.int64)
+    return (naives + span_offsets[inverse]).astype(np.float64) + micros / 1e6
+
+
+def _utc_offsets_numpy(secs):
+    import numpy as np
+
+    spans, inverse = np.unique(secs // _offset_span, return_inverse=True)
+    offsets = _local_offsets(utc=True)
+    span_offsets = [
+        _span_offset(int(s), offsets, _stamp_offset) for s in spans.tolist()
+    ]
+    exact = np.array([o is None for o in span_offsets])[inverse]
+    span_offsets = np.array([o or 0 for o in span_offsets], np.int64)[inverse]
+    if exact.any():  # Spans with a transition inside, item by item.
+        span_offsets[exact] = [_stamp_offset(s) for s in secs[exact].tolist()]
+    return span_offsets
+
+
+def _iso_many_numpy(stamps, out):
+    import numpy as np
+
+    frac, secs = np.modf(np.asarray(stamps, np.float64))
+    micros = np.round(frac * 1e6)  # Rounds just like datetime.fromtimestamp.
+    carry = np.where(micros >= 1000000, 1, np.where(micros < 0, -1, 0))
+    secs = (secs + carry).astype(np.int64)
+    micros = (micros - carry * 1000000).astype("timedelta64[us]")
+    naives = secs + _utc_offsets_numpy(secs)
+    isos = np.datetime_as_string(naives.astype("datetime64[s]") + micros, unit="us")
+    isos.view(np.uint32).reshape(len(isos), -1)[:, 10] = ord(" ")
+    if out is None:
+        return isos
+    out[...] = isos
+    return out
@@ -204,6 +204,7 @@ class JsonLogStore(PgStore):
                 % self._table,
                 ((l,) for l in logs),
                 values=True,
+                defer=True,
             )
 
     def _create(self):
@@ -1,23 +1,72 @@
+import os
 import logging
 import tempfile
 import random
 import re
 import time
 import json
+import select
+import subprocess
+import asyncio
 import psycopg2
 import threading as mt
 
 from unittest import TestCase
-from psycopg2.pool import ThreadedConnectionPool
+from contextvars import ContextVar
+from functools import lru_cache, partial
+from itertools import count
+from weakref import WeakKeyDictionary
+from collections import defaultdict, namedtuple, deque, OrderedDict
+from math import inf
+from array import array
+from queue import Queue, Empty
+from bisect import bisect_left
+from psycopg2.pool import PoolError
+from psycopg2.extensions import (
+    encodings,
+    POLL_OK,
+    POLL_READ,
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_UNKNOWN,
+)
 
-from gcd.etc import snippet, Bundle
+from gcd.etc import snippet, chunks, Bundle, KB
 from gcd.nix import sh
 
 
 logger = logging.getLogger(__name__)
 
 
-def execute(sql, args=(), cursor=None, values=False, named=False):
+def execute(
+    sql,
+    args=(),
+    cursor=None,
+    values=False,
+    named=False,
+    stream=False,
+    chunk_size=None,
+    defer=False,
+    columnar=False,
+):
+    if defer:  # Sent along with the next statement, or on commit.
+        assert not (cursor or named or stream or chunk_size or columnar)
+        return Transaction.active().defer(sql, args, values)
+    if columnar:  # A Bundle of columns, numpy arrays if columnar == "numpy".
+        assert not (named or chunk_size)
+        cursor = execute(sql, args, cursor, values, stream=stream)
+        return columns(cursor, numpy=columnar == "numpy")
+    # Streams use a server side cursor fetching stream rows (or its itersize)
+    # per round trip, and their named rows are namedtuples instead of Bundles.
+    if stream:
+        if cursor is None:
+            cursor = Transaction.active().cursor("gcd_%s" % next(_cursor_ids))
+        if stream is not True:
+            cursor.itersize = stream
+        cursor = _execute("execute", sql, args, cursor, values, False)
+        return records(cursor) if named else cursor
+    if chunk_size:  # One statement every chunk_size values, their rows are listed.
+        assert values
+        return _execute_chunks(sql, args, cursor, named, chunk_size)
     return _execute("execute", sql, args, cursor, values, named)
 
 
@@ -25,12 +74,61 @@ def executemany(sql, args, cursor=None, named=False):
     return _execute("executemany", sql, args, cursor, False, named)
 
 
+def copy_rows(table, columns, rows, cursor=None, size=64 * KB):
+    if cursor is None:
+        cursor = Transaction.active().cursor()
+    sql = "COPY %s (%s) FROM STDIN" % (table, ", ".join(columns))
+    _flush_deferred(cursor)
+    cursor.copy_expert(sql, _CopyFile(rows), size)
+    return cursor
+
+
 def named(cursor, rows=None):
-    if rows is None:
-        rows = iter(cursor.fetchone, None)
-    names = [d[0] for d in cursor.description]
-    for row in rows:
-        yield Bundle(zip(names, row))
+    names = None
+    for batch in _batches(cursor) if rows is None else (rows,):
+        names = names or [d[0] for d in cursor.description]
+        for row in batch:
+            yield Bundle(zip(names, row))
+
+
+def records(cursor, rows=None):
+    record = None
+    for batch in _batches(cursor) if rows is None else (rows,):
+        # Server side cursors only describe their rows after the first fetch.
+        record = record or _record(tuple(d[0] for d in cursor.description))
+        yield from map(record._make, batch)
+
+
+def columns(cursor, rows=None, numpy=False):
+    # Numeric columns are accumulated in arrays, unless they have NULLs.
+    cols = None
+    for batch in _batches(cursor) if rows is None else (rows,):
+        cols = cols or _new_columns(cursor.description)
+        for i, values in enumerate(zip(*batch)):
+            cols[i] = _extend_column(cols[i], values)
+    description = cursor.description or ()
+    cols = cols or _new_columns(description)
+    if numpy:
+        cols = map(_numpy_column, cols, (d[1] for d in description))
+    return Bundle(zip((d[0] for d in description), cols))
+
+
+async def aexecute(sql, args=(), cursor=None, values=False, named=False):
+    return await _aexecute(sql, args, cursor, values, named)
+
+
+async def astream(sql, args=(), named=False, itersize=2000):
+    # Like execute(stream=True). The cursor is closed with the transaction.
+    cursor = AsyncTransaction.active().cursor()
+    name = "gcd_%s" % next(_cursor_ids)
+    await _aexecute("DECLARE %s NO SCROLL CURSOR FOR %s" % (name, sql), args, cursor)
+    while True:
+        await _aexecute("FETCH %s FROM %s" % (itersize, name), (), cursor)
+        rows = cursor.fetchall()
+        if not rows:
+            return
+        for row in records(cursor, rows) if named else rows:
+            yield row
 
 
 class Transaction:
@@ -58,6 +156,8 @@ class Transaction:
         if self._pool:
             self._conn = self._pool.acquire()
         self._cursors = []
+        self._deferred = []  # Interpolated statements waiting to be sent.
+        self._deferrer = None
         Transaction._local.active = self
         return self
 
@@ -66,17 +166,32 @@ class Transaction:
         self._cursors.append(cursor)
         return cursor
 
+    def defer(self, sql, args=(), values=False):
+        if values:
+            sql, args = _values(sql, args)
+        if self._deferrer is None:
+            self._deferrer = self.cursor()
+        self._deferred.append(_mogrified(self._deferrer, sql, args))
+
+    def flush(self):  # Sends the deferred statements, in one round trip.
+        if self._deferred:
+            deferred, self._deferred = self._deferred, []
+            cursor = self._deferrer
+            _run_query(cursor.execute, ";".join(deferred), None, cursor)
+
     def __exit__(self, type_, value, traceback):
         active = Transaction.active()
         if active != self:
             return
+        flushed = True
+        if type_ is None:
+            try:
+                self.flush()
+            except Exception as error:
+                type_, value, traceback = type(error), error, error.__traceback__
+                flushed = False
         try:
-            for cursor in self._cursors:
-                try:
-                    if not getattr(cursor, "withhold", False):
-                        cursor.close()
-                except Exception:
-                    pass  # Might have been legitimately closed by the user.
+            self._close_cursors()
             if type_ is None:
                 self._conn.commit()
             else:
@@ -87,6 +202,16 @@ class Transaction:
             if self._pool:
                 self._pool.release(self._conn)
                 self._conn = None
+        if not flushed:
+            raise value
+
+    def _close_cursors(self):
+        for cursor in self._cursors:
+            try:
+                if not getattr(cursor, "withhold", False):
+                    cursor.close()
+            except Exception:
+                pass  # Might have been legitimately closed by the user.
 
 
 class Store:
@@ -112,26 +237,430 @@ class PgStore(Store):
         execute("SELECT pg_advisory_xact_lock(0)")
 
 
+class QueryProfiler:
+    # Times every query to log the slow ones, but only a sample of them is
+    # aggregated into the monitor, by fingerprint (the SQL without literals).
+
+    @staticmethod
+    def install(*args, **kwargs):
+        QueryProfiler.instance = QueryProfiler(*args, **kwargs)
+        return QueryProfiler.instance
+
+    @staticmethod
+    def uninstall():
+        QueryProfiler.instance = None
+
+    instance = None
+
+    def __init__(self, monitor, sample=0.01, slow=1, monitor_name="queries"):
+        self._monitor, self._name = monitor, monitor_name
+        self._sample = sample
+        self._slow = slow
+
+    def profile(self, fun, sql, args, cursor):
+        t0 = time.perf_counter()
+        try:
+            fun(sql, args)
+        except Exception:
+            self._monitor[self._name, _fingerprint(sql), "errors"] += 1
+            raise
+        elapsed = time.perf_counter() - t0
+        if elapsed >= self._slow:
+            log_sql = snippet(_fingerprint(sql), 500)
+            logger.warning(dict(slow_query=log_sql, time=elapsed))
+        if random.random() < self._sample:
+            monitor, fingerprint = self._monitor, _fingerprint(sql)
+            monitor.stats(self._name, fingerprint, "time", full=True).add(elapsed)
+            monitor.stats(self._name, fingerprint, "rows").add(max(0, cursor.rowcount))
+            bucket = _latency_buckets[bisect_left(_latency_bounds, elapsed)]
+            monitor[self._name, fingerprint, "latency", bucket] += 1
+
+    def dump(self):  # (fingerprint, info) pairs by total sampled time.
+        queries = self._monitor.info().get(self._name, {})
+        return sorted(queries.items(), key=lambda item: -_total_time(item[1]))
+
+
+class QueryCache:  # Rows are shared among hits, so don't modify them.
+    def __init__(self, size=1000, ttl=60, monitor=None, monitor_name="cache"):
+        self._size, self._ttl = size, ttl
+        self._entries = OrderedDict()  # Key -> (expiration time, rows, tables).
+        self._tagged = defaultdict(set)  # Table -> keys.
+        self._generation = 0  # Of invalidations, to not cache stale rows.
+        self._lock = mt.Lock()
+        self._listening = False
+        self._monitor, self._monitor_name = monitor, monitor_name
+
+    @staticmethod
+    def notify(*tables, channel="gcd_cache"):  # On commit, to every listener.
+        execute("SELECT pg_notify(%s, %s)", (channel, ",".join(tables)))
+
+    def execute(self, sql, args=(), named=False, tables=None, ttl=None):
+        try:
+            key = sql, _hashable(args), named
+            hash(key)
+        except TypeError:
+            return list(execute(sql, args, named=named))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] > time.monotonic():
+                self._entries.move_to_end(key)
+                self._count("hits")
+                return list(entry[1])
+            generation = self._generation
+        self._count("misses")
+        rows = list(execute(sql, args, named=named))
+        tables = _tables(sql) if tables is None else list(map(_table, tables))
+        expiration = time.monotonic() + (self._ttl if ttl is None else ttl)
+        with self._lock:
+            if generation == self._generation:
+                self._drop(key)
+                self._entries[key] = expiration, rows, tables
+                for table in tables:
+                    self._tagged[table].add(key)
+                while len(self._entries) > self._size:
+                    self._drop(next(iter(self._entries)))
+        return list(rows)
+
+    def invalidate(self, *tables):  # Everything if no tables are given.
+        with self._lock:
+            self._generation += 1
+            if tables:
+                keys = {k for t in tables for k in self._tagged.get(_table(t), ())}
+            else:
+                keys = list(self._entries)
+            for key in keys:
+                self._drop(key)
+
+    def listen(self, conn, channel="gcd_cache"):  # Needs its own connection.
+        conn.autocommit = True
+        with conn.cursor() as cursor:
+            cursor.execute("LISTEN " + channel)
+        self._listening = True
+        mt.Thread(target=self._listen, args=(conn,), daemon=True).start()
+        return self
+
+    def close(self):
+        self._listening = False
+
+    def _listen(self, conn):
+        try:
+            while self._listening:
+                if not select.select([conn], [], [], 1)[0]:
+                    continue
+                conn.poll()
+                tables = set()
+                while conn.notifies:
+                    tables.update(conn.notifies.pop(0).payload.split(","))
+                if tables:  # An empty payload invalidates everything.
+                    self.invalidate(*(() if "" in tables else tables))
+        except Exception:
+            logger.exception("Error listening, cache expires by TTL from now on")
+            self.invalidate()
+        finally:
+            conn.close()
+
+    def _drop(self, key):
+        entry = self._entries.pop(key, None)
+        for table in entry[2] if entry else ():
+            keys = self._tagged[table]
+            keys.discard(key)
+            if not keys:
+                del self._tagged[table]
+
+    def _count(self, what):
+        if self._monitor is not None:
+            self._monitor[self._monitor_name, what] += 1
+
+
+class PoolTimeout(PoolError):
+    pass
+
+
 class PgConnectionPool:
-    def __init__(self, *args, min_conns=1, keep_conns=10, max_conns=10, **kwargs):
-        self._pool = ThreadedConnectionPool(min_conns, max_conns, *args, **kwargs)
-        self._keep_conns = keep_conns
+    def __init__(
+        self,
+        *args,
+        min_conns=1,
+        keep_conns=10,
+        max_conns=10,
+        prepared=0,
+        timeout=None,
+        max_age=None,
+        max_idle=None,
+        check_idle=1,
+        monitor=None,
+        monitor_name="pool",
+        **kwargs
+    ):
+        self._connect = partial(psycopg2.connect, *args, **kwargs)
+        self._min_conns, self._keep_conns = min_conns, keep_conns
+        self._max_conns = max_conns
+        self._prepared = prepared  # Statements prepared per connection, if any.
+        self._timeout = timeout
+        self._max_age, self._max_idle = max_age or inf, max_idle or inf
+        self._check_idle = check_idle  # Idle seconds before pinging on checkout.
+        self._monitor, self._monitor_name = monitor, monitor_name
+        self._lock = mt.Lock()
+        self._closed = False
+        self._idle = deque()  # (connection, idle since), last released last.
+        self._born = {}  # Connection -> creation time.
+        self._waiters = deque()  # Events, first come first served.
+        self._size = min_conns  # Open connections, or being opened.
+        for _ in range(min_conns):
+            self._idle.append((self._open(), time.monotonic()))
 
-    def acquire(self):
-        pool = self._pool
-        conn = pool.getconn()
-        pool.minconn = min(self._keep_conns, len(pool._used))
+    def acquire(self, timeout=None):
+        timeout = self._timeout if timeout is None else timeout
+        deadline = None if timeout is None else time.monotonic() + timeout
+        t0 = time.monotonic()
+        self._reap()
+        conn, since = (None, None) if self._closed else self._take(deadline)
+        if self._closed:
+            raise PoolError("Connection pool is closed")
+        if conn is None or not self._alive(conn, since):
+            if conn is not None:  # Keep its slot, rather than queueing again.
+                self._close(conn)
+            conn = self._open()
+        self._probe(time.monotonic() - t0)
         return conn
 
     def release(self, conn):
-        self._pool.putconn(conn)
+        if self._closed:
+            self._close(conn)
+            return
+        if not conn.closed:
+            status = conn.info.transaction_status
+            if status == TRANSACTION_STATUS_UNKNOWN:  # The server went away.
+                self._discard(conn)
+                return
+            if status != TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    logger.warning("Can't roll back, discarding it", exc_info=True)
+                    self._discard(conn)
+                    return
+        with self._lock:
+            keep = not (conn.closed or self._expired(conn, time.monotonic()))
+            keep = keep and bool(self._waiters or len(self._idle) < self._keep_conns)
+            if keep:
+                self._give((conn, time.monotonic()))
+        if not keep:
+            self._discard(conn)
 
-    def close(self):
-        if hasattr(self, "_pool"):
-            self._pool.closeall()
+    def close(self):  # Including connections in use, like closeall.
+        if hasattr(self, "_idle"):
+            with self._lock:
+                self._closed = True
+                conns = list(self._born)
+                self._idle.clear()
+                waiters, self._waiters = self._waiters, deque()
+            for waiter in waiters:  # They'll find the pool closed.
+                waiter.set()
+            for conn in conns:
+                self._close(conn)
 
     __del__ = close
 
+    def _take(self, deadline):
+        with self._lock:
+            if not self._waiters:
+                if self._idle:
+                    return self._idle.pop()
+                if self._size < self._max_conns:
+                    self._size += 1
+                    return None, None
+            waiter = mt.Event()
+            waiter.item = None
+            self._waiters.append(waiter)
+        timeout = None if deadline is None else max(0, deadline - time.monotonic())
+        if not waiter.wait(timeout):
+            with self._lock:
+                if not waiter.is_set():  # Otherwise it was just given something.
+                    self._waiters.remove(waiter)
+                    if self._monitor is not None:
+                        self._monitor[self._monitor_name, "timeouts"] += 1
+                    raise PoolTimeout("No connection available in time")
+        return waiter.item or (None, None)
+
+    def _give(self, item):  # A connection or, if None, a slot to open one.
+        if self._waiters:
+            waiter = self._waiters.popleft()
+            waiter.item = item
+            waiter.set()
+        elif item:
+            self._idle.append(item)
+        else:
+            self._size -= 1
+
+    def _open(self):  # Within a slot already taken.
+        try:
+            conn = self._connect()
+        except Exception:
+            with self._lock:
+                self._give(None)
+            raise
+        self._born[conn] = time.monotonic()
+        if self._prepared:
+            _statements[conn] = _Statements(self._prepared)
+        return conn
+
+    def _alive(self, conn, since):
+        now = time.monotonic()
+        if conn.closed or self._expired(conn, now):
+            return False
+        if now - since < self._check_idle:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _expired(self, conn, now):
+        return now - self._born.get(conn, now) > self._max_age
+
+    def _reap(self):  # Idle connections too old, or idle for too long.
+        now = time.monotonic()
+        with self._lock:
+            idle, reaped = deque(), []
+            for conn, since in self._idle:
+                spare = self._size - len(reaped) > self._min_conns
+                if self._expired(conn, now) or (spare and now - since > self._max_idle):
+                    reaped.append(conn)
+                else:
+                    idle.append((conn, since))
+            self._idle = idle
+            self._size -= len(reaped)
+        for conn in reaped:
+            self._close(conn)
+
+    def _discard(self, conn):  # Frees its slot too.
+        self._close(conn)
+        with self._lock:
+            self._give(None)
+
+    def _close(self, conn):
+        self._born.pop(conn, None)
+        _statements.pop(conn, None)
+        try:
+            conn.close()
+        except Exception:
+            logger.exception("Error closing connection")
+
+    def _probe(self, wait):
+        monitor, name = self._monitor, self._monitor_name
+        if monitor is None:
+            return
+        monitor.stats(name, "wait", full=True).add(wait)
+        with self._lock:
+            monitor[name, "size"] = self._size
+            monitor[name, "in_use"] = self._size - len(self._idle)
+            monitor[name, "waiters"] = len(self._waiters)
+
+
+class AsyncTransaction:
+
+    pool = None
+
+    _active = ContextVar("active_transaction", default=None)
+
+    @staticmethod
+    def active():
+        return AsyncTransaction._active.get()
+
+    def __init__(self, conn_or_pool=None):
+        conn_or_pool = conn_or_pool or AsyncTransaction.pool
+        self._pool = self._conn = None
+        if hasattr(conn_or_pool, "cursor"):
+            self._conn = conn_or_pool
+        else:
+            self._pool = conn_or_pool
+
+    async def __aenter__(self):
+        active = AsyncTransaction.active()
+        if active:
+            return active
+        if self._pool:
+            self._conn = await self._pool.acquire()
+        self._lock = asyncio.Lock()  # One query at a time, even from other tasks.
+        try:
+            await _aexecute("BEGIN", (), self._conn.cursor())
+        except Exception:
+            await self._release()
+            raise
+        self._token = AsyncTransaction._active.set(self)
+        return self
+
+    def cursor(self, *args, **kwargs):
+        return self._conn.cursor(*args, **kwargs)
+
+    async def __aexit__(self, type_, value, traceback):
+        active = AsyncTransaction.active()
+        if active != self:
+            return
+        try:
+            if type_ is None:
+                await _aexecute("COMMIT", (), self._conn.cursor())
+            else:
+                logger.error("Transaction rollback", exc_info=(type_, value, traceback))
+                await _aexecute("ROLLBACK", (), self._conn.cursor())
+        finally:
+            AsyncTransaction._active.reset(self._token)
+            await self._release()
+
+    async def _release(self):
+        if self._pool:
+            await self._pool.release(self._conn)
+            self._conn = None
+
+
+class AsyncPgConnectionPool:  # Of asynchronous connections, see psycopg2 docs.
+    def __init__(self, *args, keep_conns=10, max_conns=10, timeout=None, **kwargs):
+        self._connect = partial(psycopg2.connect, *args, async_=True, **kwargs)
+        self._keep_conns = keep_conns
+        self._timeout = timeout
+        self._idle = []
+        self._slots = asyncio.Semaphore(max_conns)  # Its waiters are served FIFO.
+
+    async def acquire(self, timeout=None):
+        timeout = self._timeout if timeout is None else timeout
+        try:
+            await asyncio.wait_for(self._slots.acquire(), timeout)
+        except asyncio.TimeoutError:
+            raise PoolTimeout("No connection available in time") from None
+        try:
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    return conn
+            conn = self._connect()
+            await _wait(conn)
+            return conn
+        except BaseException:
+            self._slots.release()
+            raise
+
+    async def release(self, conn):
+        try:
+            status = None if conn.closed else conn.info.transaction_status
+            if status not in (None, TRANSACTION_STATUS_UNKNOWN):
+                if status != TRANSACTION_STATUS_IDLE:
+                    await _aexecute("ROLLBACK", (), conn.cursor())
+                if len(self._idle) < self._keep_conns:
+                    self._idle.append(conn)
+                    return
+            conn.close()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.close()
+
 
 class PgTestCase(TestCase):
 
@@ -173,41 +702,241 @@ class PrestoError(Exception):
 
 
 def query_presto_cli(
-    query, command="presto-cli", prefetch=False, prefetch_dir="/tmp", **kwargs
+    query,
+    command="presto-cli",
+    prefetch=False,
+    prefetch_dir="/tmp",
+    partitions=None,
+    workers=4,
+    done=None,
+    chunk_size=64 * KB,
+    **kwargs
 ):
-    def stdout_lines():
-        try:
-            while True:
-                line = proc.stdout.readline()
-                if not line:
-                    return
-                yield line
-        finally:
-            wait_time = 30
-            return_code = proc.wait(wait_time)
-            if return_code != 0:  # Subprocess i. has errors or ii. hasn't ended yet
-                if return_code is not None:  # i. has errors => raise exception
-                    raise PrestoError(proc.stderr.readline().rstrip("\n"))
-                try:  # ii. hasn't ended yet => terminate it (SIGTERM)
-                    logger.warning("%s hasn't ended after %s seconds", wait_time)
-                    proc.stdout.close()  # Seems to help stopping the query
-                    proc.terminate()
-                except Exception:
-                    logger.exception("Failed to terminate %s", command)
+    run = partial(
+        _query_presto_cli,
+        command=command,
+        prefetch=prefetch,
+        prefetch_dir=prefetch_dir,
+        chunk_size=chunk_size,
+        kwargs=kwargs,
+    )
+    if partitions is None:
+        batches = run(query)[1]
+    else:
+        batches = _partitioned(run, query, partitions, workers, done)
+    for batch in batches:
+        yield from batch
 
+
+def _query_presto_cli(query, command, prefetch, prefetch_dir, chunk_size, kwargs):
     if query and query.rstrip()[-1] != ";":
         query += ";"
-    kwargs.update(file="/dev/stdin", output_format="JSON")
+    kwargs = dict(kwargs, file="/dev/stdin", output_format="JSON")
     args = ("--%s %s" % (k.replace("_", "-"), v) for k, v in kwargs.items())
     proc = sh("exec %s %s |&" % (command, " ".join(args)), query)
+    chunks = _stdout_chunks(proc, command, chunk_size)
     if prefetch:
-        with tempfile.TemporaryFile(dir=prefetch_dir, mode="w+") as prefetch_file:
-            for line in stdout_lines():
-                prefetch_file.write(line)
-            prefetch_file.seek(0)
-            yield from map(json.loads, prefetch_file)
+        chunks = _prefetched(chunks, proc, prefetch_dir, chunk_size)
+    return proc, _json_batches(chunks)
+
+
+def _stdout_chunks(proc, command, chunk_size):
+    finished = False
+    try:
+        while True:
+            chunk = proc.stdout.buffer.read1(chunk_size)
+            if not chunk:
+                break
+            yield chunk
+        finished = True
+    finally:
+        wait_time = 30 if finished else 0
+        try:
+            return_code = proc.wait(wait_time)
+        except subprocess.TimeoutExpired:
+            return_code = None
+        if finished and return_code:
+            raise PrestoError(proc.stderr.readline().rstrip("\n"))
+        if return_code is None:  # Not ended or not read to the end => terminate it.
+            if finished:
+                logger.warning("%s hasn't ended after %s seconds", command, wait_time)
+            try:
+                proc.stdout.close()  # Seems to help stopping the query
+                proc.terminate()
+            except Exception:
+                logger.exception("Failed to terminate %s", command)
+
+
+def _json_batches(chunks):  # Decodes all the complete lines of a chunk at once.
+    rest = b""
+    for chunk in chunks:
+        lines = (rest + chunk).split(b"\n")
+        rest = lines.pop()
+        if lines:
+            yield json.loads(b"[%s]" % b",".join(filter(None, lines)))
+    if rest.strip():
+        yield [json.loads(rest)]
+
+
+def _prefetched(chunks, proc, prefetch_dir, chunk_size):
+    # Downloads into a file from a thread, so presto never waits for a slow consumer,
+    # while the consumer reads back whatever has already been downloaded.
+    with tempfile.TemporaryFile(dir=prefetch_dir) as file:
+        fd = file.fileno()
+        state = Bundle(size=0, done=False, stop=False, error=None)
+        cond = mt.Condition()
+
+        def download():
+            try:
+                for chunk in chunks:
+                    if state.stop:
+                        break
+                    os.pwrite(fd, chunk, state.size)
+                    with cond:
+                        state.size += len(chunk)
+                        cond.notify()
+            except Exception as error:
+                state.error = error
+            finally:
+                chunks.close()
+                with cond:
+                    state.done = True
+                    cond.notify()
+
+        thread = mt.Thread(target=download, daemon=True)
+        thread.start()
+        offset = 0
+        try:
+            while True:
+                with cond:
+                    cond.wait_for(lambda: offset < state.size or state.done)
+                    size = state.size
+                if offset < size:
+                    chunk = os.pread(fd, min(size - offset, chunk_size), offset)
+                    offset += len(chunk)
+                    yield chunk
+                elif state.error:
+                    raise state.error
+                else:
+                    return
+        finally:
+            state.stop = True
+            if not state.done:  # Its download may be blocked waiting for output.
+                proc.terminate()
+            thread.join()  # Before the file gets closed.
+
+
+def _partitioned(run, query, partitions, workers, done):
+    # Runs a query per partition from a few threads, gathering their batches as they
+    # come. Partitions are reported to done once all their rows have been yielded,
+    # so that a failed query can be resumed by running just the remaining ones.
+    todo = Queue()
+    for partition in partitions:
+        todo.put(partition)
+    pending = todo.qsize()
+    batches = Queue(4 * workers)
+    procs = []  # Those started by the workers, terminated on stop.
+    stop = mt.Event()
+    work = partial(_work_partitions, run, query, todo, batches, procs, stop)
+    threads = [mt.Thread(target=work, daemon=True) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    try:
+        while pending:
+            partition, batch = batches.get()
+            if isinstance(batch, Exception):
+                raise batch
+            elif batch is None:
+                pending -= 1
+                if done is not None:
+                    done.append(partition)
+            else:
+                yield batch
+    finally:
+        stop.set()
+        for proc in procs[:]:  # Workers may be blocked waiting for their output.
+            proc.terminate()
+        for thread in threads:
+            while thread.is_alive():  # Unblock it if waiting for room in batches.
+                try:
+                    batches.get(timeout=0.1)
+                except Empty:
+                    pass
+
+
+def _work_partitions(run, query, todo, batches, procs, stop):
+    while not stop.is_set():
+        try:
+            partition = todo.get_nowait()
+        except Empty:
+            return
+        try:
+            proc, partition_batches = run(
+                query.replace("{partition}", "(%s)" % partition)
+            )
+            procs.append(proc)
+            if stop.is_set():  # Maybe too late to be terminated on stop.
+                proc.terminate()
+            for batch in partition_batches:
+                if stop.is_set():
+                    partition_batches.close()
+                    return
+                batches.put((partition, batch))
+            batches.put((partition, None))
+        except Exception as error:
+            batches.put((partition, error))
+
+
+def _deferred(cursor):  # Statements deferred in the cursor's transaction.
+    active = Transaction.active()
+    if active and active._deferred and cursor.connection is active._conn:
+        return active._deferred
+
+
+def _mogrified(cursor, sql, args):
+    return cursor.mogrify(sql, args).decode(encodings[cursor.connection.encoding])
+
+
+def _flush_deferred(cursor):
+    if _deferred(cursor):
+        Transaction.active().flush()
+
+
+async def _aexecute(sql, args, cursor, values=False, named_=False):
+    active = AsyncTransaction.active()
+    if cursor is None:
+        cursor = active.cursor()
+    if values:
+        sql, args = _values(sql, args)
+    if active and cursor.connection is active._conn:  # Tasks share the transaction.
+        async with active._lock:
+            cursor.execute(sql, args)
+            await _wait(cursor.connection)
     else:
-        yield from map(json.loads, stdout_lines())
+        cursor.execute(sql, args)
+        await _wait(cursor.connection)
+    return named(cursor) if named_ else cursor
+
+
+async def _wait(conn):  # Until an asynchronous connection is done.
+    loop = asyncio.get_running_loop()
+    while True:
+        state = conn.poll()
+        if state == POLL_OK:
+            return
+        ready = loop.create_future()
+        fd = conn.fileno()
+        if state == POLL_READ:
+            loop.add_reader(fd, ready.set_result, None)
+        else:
+            loop.add_writer(fd, ready.set_result, None)
+        try:
+            await ready
+        finally:
+            if state == POLL_READ:
+                loop.remove_reader(fd)
+            else:
+                loop.remove_writer(fd)
 
 
 def _execute(attr, sql, args, cursor, values, named_):
@@ -216,11 +945,236 @@ def _execute(attr, sql, args, cursor, values, named_):
     fun = getattr(cursor, attr)
     if values:
         sql, args = _values(sql, args)
+    elif cursor.name is None and cursor.connection in _statements:
+        sql = _statements[cursor.connection].execute_sql(cursor, sql)
+    deferred = _deferred(cursor)
+    if deferred and attr == "execute" and cursor.name is None:
+        deferred.append(_mogrified(cursor, sql, args))  # All in one round trip.
+        sql, args = ";".join(deferred), None
+        deferred.clear()
+    elif deferred:
+        _flush_deferred(cursor)
+    _run_query(fun, sql, args, cursor)
+    return named(cursor) if named_ else cursor
+
+
+def _run_query(fun, sql, args, cursor):  # Logged in DEBUG, or maybe profiled.
     if logger.isEnabledFor(logging.DEBUG):
         _debugged(fun, sql, args)
+    elif QueryProfiler.instance:
+        QueryProfiler.instance.profile(fun, sql, args, cursor)
     else:
         fun(sql, args)
-    return named(cursor) if named_ else cursor
+
+
+class _Statements:  # LRU of the statements prepared in a connection.
+    def __init__(self, size):
+        self._size = size
+        self._sqls = OrderedDict()  # SQL -> (name, EXECUTE SQL) or None.
+
+    def execute_sql(self, cursor, sql):
+        try:
+            self._sqls.move_to_end(sql)
+            statement = self._sqls[sql]
+        except KeyError:
+            statement = self._sqls[sql] = self._prepare(cursor, sql)
+            if len(self._sqls) > self._size:
+                evicted = self._sqls.popitem(last=False)[1]
+                if evicted:
+                    cursor.execute("DEALLOCATE " + evicted[0])
+        return statement[1] if statement else sql
+
+    def _prepare(self, cursor, sql):
+        sql = sql.rstrip().rstrip(";")
+        if not _preparable_regex.match(sql) or ";" in sql:
+            return None
+        name = "gcd_%s" % next(_statement_ids)
+        params = []  # Placeholders in EXECUTE, the nth one is $n.
+        prepare_sql = "PREPARE %s AS %s" % (
+            name,
+            _placeholder_regex.sub(lambda m: _parameter(m[0], params), sql),
+        )
+        # Statements with parameters of unknown type, like SELECT %s, can't be
+        # prepared, so try in a savepoint to leave the transaction usable.
+        if not cursor.connection.autocommit:
+            prepare_sql = "SAVEPOINT gcd; %s; RELEASE gcd" % prepare_sql
+        try:
+            cursor.execute(prepare_sql)
+        except psycopg2.Error:
+            logger.debug("Can't prepare %s", snippet(sql, 100), exc_info=True)
+            if not cursor.connection.autocommit:
+                cursor.execute("ROLLBACK TO gcd; RELEASE gcd")
+            return None
+        args_sql = "(%s)" % ", ".join(params) if params else ""
+        return name, "EXECUTE %s%s" % (name, args_sql)
+
+
+def _parameter(placeholder, params):
+    if placeholder == "%%":
+        return "%"
+    if placeholder != "%s" and placeholder in params:  # Named ones might repeat.
+        return "$%s" % (params.index(placeholder) + 1)
+    params.append(placeholder)
+    return "$%s" % len(params)
+
+
+_statements = WeakKeyDictionary()  # Connection -> _Statements.
+
+_statement_ids = count()
+
+_preparable_regex = re.compile(r"\s*(SELECT|INSERT|UPDATE|DELETE|VALUES|WITH)\b", re.I)
+
+_placeholder_regex = re.compile(r"%(\(\w+\))?s|%%")
+
+
+class _CopyFile:  # Encodes rows into COPY text format as they're read.
+    def __init__(self, rows):
+        self._lines = map(_copy_line, rows)
+
+    def read(self, size=-1):
+        lines, length = [], 0
+        for line in self._lines:
+            lines.append(line)
+            length += len(line)
+            if length >= size >= 0:
+                break
+        return "".join(lines)
+
+
+def _copy_line(row):
+    return "\t".join(map(_copy_value, row)) + "\n"
+
+
+def _copy_value(value):
+    encode = _copy_encoders.get(type(value))
+    if encode:
+        return encode(value)
+    if value is None:
+        return "\\N"
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return "\\\\x" + bytes(value).hex()
+    return str(value).translate(_copy_escapes)
+
+
+_copy_escapes = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+_copy_encoders = {
+    str: lambda value: value.translate(_copy_escapes),
+    int: str,
+    float: repr,
+    bool: lambda value: "t" if value else "f",
+    dict: lambda value: json.dumps(value).translate(_copy_escapes),
+    list: lambda value: _array_literal(value).translate(_copy_escapes),
+}
+
+
+def _array_literal(items):  # Like psycopg2 adapts lists, {"a","b"} or {1,NULL}.
+    return "{%s}" % ",".join(map(_array_item, items))
+
+
+def _array_item(item):
+    if item is None:
+        return "NULL"
+    if type(item) is list:
+        return _array_literal(item)
+    if type(item) is bool:
+        return "t" if item else "f"
+    text = json.dumps(item) if type(item) is dict else str(item)
+    return '"%s"' % text.replace("\\", "\\\\").replace('"', '\\"')
+
+
+def _hashable(args):
+    return tuple(sorted(args.items())) if isinstance(args, dict) else tuple(args)
+
+
+def _tables(sql):
+    items = (i for m in _tables_regex.findall(sql) for i in m.split(","))
+    return sorted({_table(i.split()[0]) for i in items})
+
+
+def _table(name):  # Without its schema, so qualified or not they match.
+    return name.replace('"', "").lower().rsplit(".", 1)[-1]
+
+
+# Lists of tables like a, b x, c AS y, looking ahead so matches can overlap.
+_tables_regex = re.compile(
+    r"(?=\b(?:FROM|JOIN|INTO|UPDATE)\s+("
+    r"[\w.\"]+(?:\s+(?:AS\s+)?[\w\"]+)?"
+    r"(?:\s*,\s*[\w.\"]+(?:\s+(?:AS\s+)?[\w\"]+)?)*))",
+    re.I,
+)
+
+
+def _batches(cursor):
+    while True:
+        rows = cursor.fetchmany(cursor.itersize)
+        if not rows:
+            return
+        yield rows
+
+
+@lru_cache(maxsize=256)
+def _record(names):
+    return namedtuple("Record", names, rename=True)
+
+
+def _new_columns(description):
+    codes = (_typecodes.get(d[1]) for d in description)
+    return [array(code) if code else [] for code in codes]
+
+
+def _extend_column(col, values):
+    if type(col) is array:
+        size = len(col)
+        try:
+            col.extend(values)
+            return col
+        except (TypeError, OverflowError):  # NULLs (or numbers out of range).
+            col = col[:size].tolist()
+    col.extend(values)
+    return col
+
+
+def _numpy_column(col, type_code):
+    import numpy as np
+
+    if type(col) is array:
+        return np.frombuffer(col, "?" if type_code == _bool_oid else col.typecode)
+    return np.fromiter(col, object, len(col))
+
+
+_bool_oid = 16
+
+_typecodes = {  # Type OID -> array typecode.
+    _bool_oid: "b",
+    20: "q",  # int8
+    21: "h",  # int2
+    23: "i",  # int4
+    26: "I",  # oid
+    700: "f",  # float4
+    701: "d",  # float8
+}
+
+
+_cursor_ids = count()
+
+
+def _execute_chunks(sql, args, cursor, named_, chunk_size):
+    if cursor is None:
+        cursor = Transaction.active().cursor()
+    rows, full_sql = [], None
+    for chunk in chunks(args, chunk_size):
+        chunk = list(chunk)
+        chunk_args = [v for arg in chunk for v in arg]
+        if len(chunk) == chunk_size:  # Full chunks share their SQL.
+            full_sql = full_sql or _values_sql(sql, len(chunk[0]), chunk_size)
+            chunk_sql = full_sql
+        else:
+            chunk_sql = _values_sql(sql, len(chunk[0]), len(chunk))
+        _execute("execute", chunk_sql, chunk_args, cursor, False, False)
+        if cursor.description is not None:  # Those of RETURNING, for every chunk.
+            rows.extend(named(cursor) if named_ else cursor.fetchall())
+    return rows
 
 
 def _values(sql, args):  # args can be any iterable.
@@ -228,18 +1182,43 @@ def _values(sql, args):  # args can be any iterable.
     arg = next(args_iter)
     args = list(arg)
     args.extend(v for a in args_iter for v in a)
-    value_sql = "(" + ",".join(["%s"] * len(arg)) + ")"
-    values_sql = "VALUES " + ",".join([value_sql] * (len(args) // len(arg)))
-    sql %= values_sql
-    return sql, args
+    return _values_sql(sql, len(arg), len(args) // len(arg)), args
+
+
+def _values_sql(sql, width, count):
+    value_sql = "(" + ",".join(["%s"] * width) + ")"
+    return sql % ("VALUES " + ",".join([value_sql] * count))
+
+
+@lru_cache(maxsize=1024)
+def _fingerprint(sql):
+    for regex, replacement in _fingerprint_regexes:
+        sql = regex.sub(replacement, sql)
+    return sql.strip()
+
+
+_fingerprint_regexes = [
+    (re.compile(r"'(?:[^']|'')*'"), "?"),  # Strings.
+    (re.compile(r"\b\d+(?:\.\d+)?\b"), "?"),  # Numbers.
+    (re.compile(r"\([%s?,\s]*\)(?:\s*,\s*\([%s?,\s]*\))+"), "(...)"),  # VALUES.
+    (re.compile(r"\s+"), " "),
+]
+
+_latency_bounds = 0.001, 0.01, 0.1, 1, 10
+
+_latency_buckets = [*("<=%ss" % b for b in _latency_bounds), ">10s"]
+
+
+def _total_time(info):
+    time = info.get("time", {})
+    return time.get("n", 0) * time.get("mean", 0)
 
 
 def _debugged(fun, sql, args):
-    query_id = random.randint(0, 10000)
+    query_id = next(_query_ids)
     log_sql = snippet(re.sub(r"[\n\t ]+", " ", sql[:500]).strip(), 100)
-    log_args = snippet(
-        str((list(args.items()) if isinstance(args, dict) else args)[:20]), 100
-    )
+    log_args = list(args.items()) if isinstance(args, dict) else args
+    log_args = snippet(str(log_args and log_args[:20]), 100)  # None if deferred.
     logger.debug(dict(query=query_id, sql=log_sql, args=log_args))
     try:
         t0 = time.perf_counter()
@@ -248,3 +1227,6 @@ def _debugged(fun, sql, args):
         logger.debug(dict(query=query_id, time=t1 - t0))
     except Exception:
         logger.exception(dict(query=query_id))
+
+
+_query_ids = count()
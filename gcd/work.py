@@ -1,12 +1,25 @@
+import os
+import time
+import heapq
+import asyncio
+import struct
+import inspect
 import logging
+import ctypes as ct
 import multiprocessing as mp
 import threading as mt
 
-from queue import Empty, Queue
-
-from gcd.etc import new
-from gcd.chronos import as_timer
+from queue import Empty, Full, Queue
+from collections import deque
+from concurrent.futures import Future, FIRST_COMPLETED, as_completed, wait
+from math import inf
+from array import array
+from functools import partial
+from contextlib import nullcontext
+from itertools import count
 
+from gcd.etc import new, chunks, MB
+from gcd.chronos import Timer, as_timer
 
 logger = logging.getLogger(__name__)
 
@@ -14,16 +27,21 @@ default_hwm = 10000
 
 default_period = 1
 
+default_shared_size = 16 * MB
+
+_header = struct.Struct("I")
+
 
 class Process(mp.Process):
 
     init = None
 
     def __init__(self, target, *args, daemon=True, **kwargs):
+        init = getattr(self.init, "__func__", self.init)  # Plain functions bind.
         super().__init__(
             target=self._wrapper,
             daemon=daemon,
-            args=(self.init, target, *args),
+            args=(init, target, *args),
             kwargs=kwargs,
         )
 
@@ -51,14 +69,37 @@ class Thread(mt.Thread):
 class Worker:
     def __init__(self, *args, new_process=False, **kwargs):
         worker_class = Process if new_process else Thread
-        self.worker = worker_class(*args, *kwargs)
+        self._new_worker = partial(worker_class, *args, **kwargs)
+        self.worker = self._new_worker()
 
     def start(self):
         self.worker.start()
         return self
 
-    def join(self):
-        self.worker.join()
+    def join(self, timeout=None):
+        self.worker.join(timeout)
+
+    def drain(self, timeout=None):
+        self.join(timeout)
+
+    def is_alive(self):
+        return self.worker.is_alive()
+
+    @property
+    def crashed(self):  # Only processes crash, tasks log their errors and go on.
+        return _crashed(self.worker)
+
+    def restart(self):
+        self.worker = self._new_worker()
+        self.worker.start()
+        return self
+
+    def terminate(self):  # Threads can't be terminated, but they're daemons.
+        if isinstance(self.worker, Process):
+            self.worker.terminate()
+
+    def _spawned(self):  # Itself and every worker it spawned, for supervision.
+        yield self
 
 
 class Task(Worker):
@@ -66,12 +107,48 @@ class Task(Worker):
     class Stop:
         pass
 
-    def __init__(self, period_or_timer, callback, *args, new_process=False, **kwargs):
+    def __init__(
+        self,
+        period_or_timer,
+        callback,
+        *args,
+        new_process=False,
+        scheduler=None,
+        **kwargs
+    ):
         timer = as_timer(period_or_timer)
         self.__stop = False
-        super().__init__(
-            self._run, timer, callback, args, kwargs, new_process=new_process
-        )
+        self._scheduler = scheduler
+        if scheduler:
+            assert not new_process
+            self._job = timer, self._scheduled, callback, args, kwargs
+            self._stopped = mt.Event()
+            self.worker = None
+        else:
+            super().__init__(
+                self._run, timer, callback, args, kwargs, new_process=new_process
+            )
+
+    def start(self):
+        if self._scheduler:
+            self._scheduler.add(*self._job)
+            return self
+        return super().start()
+
+    def join(self, timeout=None):
+        if self._scheduler:
+            self._stopped.wait(timeout)
+        else:
+            super().join(timeout)
+
+    def drain(self, timeout=None):
+        self.stop()
+        self.join(timeout)
+
+    def is_alive(self):
+        if self._scheduler:
+            return not self._stopped.is_set()
+        return super().is_alive()
 
     def stop(self):
         self.__stop = True
@@ -81,11 +158,119 @@ class Task(Worker):
         while True:
             try:
                 timer.wait()
-                if self.__stop or callback(*args, **kwargs) is Task.Stop:
-                    logger.info("Task cleanly stopped")
-                    return
             except Exception:
                 logger.exception("Error executing task")
+                continue
+            if self._step(callback, args, kwargs) is Task.Stop:
+                return
+
+    def _scheduled(self, callback, args, kwargs):
+        if self._step(callback, args, kwargs) is Task.Stop:
+            self._stopped.set()
+            return Task.Stop
+
+    def _step(self, callback, args, kwargs):
+        try:
+            if self.__stop or callback(*args, **kwargs) is Task.Stop:
+                logger.info("Task cleanly stopped")
+                return Task.Stop
+        except Exception:
+            logger.exception("Error executing task")
+
+
+class Scheduler(Thread):
+    def __init__(self, workers=4):
+        super().__init__(self._run)
+        self._jobs = []  # Heap of (monotonic due time, sequence, job).
+        self._cond = mt.Condition()
+        self._seq = count()
+        # Due callbacks run in a pool, so a slow one doesn't delay the others.
+        self._pool = Pool(workers)
+
+    def start(self):
+        self._pool.start()
+        return super().start()
+
+    def add(self, timer, callback, *args, **kwargs):
+        job = timer, callback, args, kwargs
+        with self._cond:
+            self._push(job)
+        return self
+
+    def _push(self, job):
+        timer = job[0]
+        due = timer.next_time
+        if not timer.monotonic:
+            due += time.monotonic() - time.time()
+        heapq.heappush(self._jobs, (due, next(self._seq), job))
+        self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._jobs or self._jobs[0][0] > time.monotonic():
+                    timeout = (
+                        self._jobs[0][0] - time.monotonic() if self._jobs else None
+                    )
+                    self._cond.wait(timeout)
+                job = heapq.heappop(self._jobs)[2]
+            self._pool.submit(self._execute, job)
+
+    def _execute(self, job):  # Jobs are pushed back once done, never run twice.
+        timer, callback, args, kwargs = job
+        try:
+            if timer.is_time and callback(*args, **kwargs) is Task.Stop:
+                return
+        except Exception:
+            logger.exception("Error executing scheduled callback")
+        with self._cond:
+            self._push(job)
+
+
+class Supervisor(Task):
+    def __init__(self, period=None, backoff=1, max_backoff=60):
+        self._watched = []
+        self._states = {}  # Worker -> [restarts, restart time, start time].
+        self._lock = mt.Lock()
+        self._backoff, self._max_backoff = backoff, max_backoff
+        super().__init__(period or default_period, self._check)
+
+    def watch(self, worker):
+        with self._lock:
+            self._watched.append(worker)
+            for spawned in worker._spawned():
+                self._states[spawned] = [0, None, time.monotonic()]
+        return worker
+
+    def shutdown(self, deadline=None):  # True if every worker drained in time.
+        self.stop()
+        self.join()
+        deadline, timeout = _deadline(deadline), deadline
+        for worker in self._watched:
+            worker.drain(_remaining(deadline))
+        alive = [worker for worker in self._states if worker.is_alive()]
+        if alive:
+            logger.warning("%s workers not drained in %ss", len(alive), timeout)
+        for worker in alive:
+            worker.terminate()
+        return not alive
+
+    def _check(self):
+        with self._lock:
+            states = list(self._states.items())
+        now = time.monotonic()
+        for worker, state in states:
+            restarts, restart_time, start_time = state
+            if not worker.crashed:
+                if restarts and now - start_time >= self._max_backoff:
+                    state[0] = 0  # Healthy for long enough to forget past crashes.
+            elif restart_time is None:
+                delay = min(self._backoff * 2**restarts, self._max_backoff)
+                logger.error("Worker crashed, restarting it in %ss", delay)
+                state[1] = now + delay
+            elif now >= restart_time:
+                worker.restart()
+                state[:] = restarts + 1, None, now
 
 
 class Batcher(Task):
@@ -97,9 +282,47 @@ class Batcher(Task):
         period=None,
         queue=None,
         new_process=False,
+        scheduler=None,
+        max_batch=None,
+        max_age=None,
+        max_bytes=None,
+        sizeof=len,
+        workers=None,
+        results=False,
+        ordered=False,
+        monitor=None,
+        monitor_name="batcher",
         **kwargs
     ):
         self._queue = queue or new_queue(hwm, new_process)
+        self._probe = _Probe(monitor, monitor_name)
+        self._limits = None
+        if max_batch or max_age or max_bytes:
+            assert not scheduler  # Early flushes need to block waiting for items.
+            self._limits = max_batch or inf, max_age or inf, max_bytes or inf, sizeof
+        self._workers = []
+        self._results = None
+        if workers:  # Batches are built here but handled by a pool of processes.
+            assert not (new_process or scheduler)
+            self._batches = mp.Queue(2 * workers)
+            self._results = mp.Queue() if results else None
+            self._workers = [
+                Worker(
+                    _handle_batches,
+                    self._batches,
+                    self._results,
+                    handle_batch,
+                    args,
+                    kwargs,
+                    new_process=True,
+                )
+                for _ in range(workers)
+            ]
+            self._ordered = ordered
+            self._seqs = count()
+            self._next_seq = 0
+            self._pending = {}
+            handle_batch, args, kwargs = self._dispatch, (), {}
         super().__init__(
             period or default_period,
             self._callback,
@@ -107,22 +330,100 @@ class Batcher(Task):
             args,
             kwargs,
             new_process=new_process,
+            scheduler=scheduler,
         )
 
+    def start(self):
+        for worker in self._workers:
+            worker.start()
+        return super().start()
+
     def put(self, obj, *args, **kwargs):
-        self._queue.put(obj, *args, **kwargs)
+        self._probe.put(self._queue, obj, *args, **kwargs)
+
+    def get(self, block=True, timeout=None):  # Next result when workers are used.
+        assert self._results is not None, "Batcher.get needs workers and results"
+        if self._ordered:
+            while self._next_seq not in self._pending:
+                seq, *result = self._results.get(block, timeout)
+                self._pending[seq] = result
+            ok, result = self._pending.pop(self._next_seq)
+            self._next_seq += 1
+        else:
+            _, ok, result = self._results.get(block, timeout)
+        if not ok:
+            raise result
+        return result
+
+    def join(self, timeout=None):  # Handles every item put so far.
+        deadline = _deadline(timeout)
+        try:
+            self._queue.put(Task.Stop, timeout=timeout)
+            super().join(timeout)
+            if self.is_alive():
+                return
+            for _ in self._workers:
+                self._batches.put(Task.Stop, timeout=_remaining(deadline))
+        except Full:  # The queue isn't moving, maybe its consumer died.
+            return
+        for worker in self._workers:
+            worker.join(_remaining(deadline))
+
+    def drain(self, timeout=None):
+        self.join(timeout)
 
-    def join(self):
-        self._queue.put(Task.Stop)
-        super().join()
+    def _spawned(self):
+        yield from super()._spawned()
+        for worker in self._workers:
+            yield from worker._spawned()
+
+    def _dispatch(self, batch):
+        self._batches.put((next(self._seqs), batch))
+
+    def _run(self, timer, callback, args, kwargs):
+        if not self._limits:
+            return super()._run(timer, callback, args, kwargs)
+        self._timer = timer
+        while self._step(callback, args, kwargs) is not Task.Stop:
+            pass
 
     def _callback(self, handle_batch, args, kwargs):
-        batch = list(dequeue(self._queue, 1))
+        if self._limits:
+            batch = self._collect()
+        else:
+            # Don't block a scheduler worker waiting for the first item.
+            batch = list(dequeue(self._queue, 0 if self._scheduler else 1))
+        if not batch:
+            return
         stop = batch[-1] is Task.Stop
-        handle_batch(batch[:-1] if stop else batch, *args, **kwargs)
+        if stop:
+            batch.pop()
+        self._probe.batch(self._queue, len(batch))
+        with self._probe.timeit("handle"):
+            handle_batch(batch, *args, **kwargs)
         if stop:
             return Task.Stop
 
+    def _collect(self):  # Until the period ends or any limit is reached.
+        max_batch, max_age, max_bytes, sizeof = self._limits
+        timer = self._timer
+        batch, size, deadline = [], 0, inf
+        while len(batch) < max_batch and size < max_bytes:
+            timeout = min(timer.delay, deadline - time.monotonic())
+            try:
+                obj = self._queue.get(timeout=max(0, timeout))
+            except Empty:
+                break
+            batch.append(obj)
+            if obj is Task.Stop:
+                break
+            if len(batch) == 1:
+                deadline = time.monotonic() + max_age
+            if max_bytes is not inf:
+                size += sizeof(obj)
+        timer.is_time  # Move on to the next period once this one is due.
+        return batch
+
 
 class Streamer(Task):
     def __init__(
@@ -133,42 +434,477 @@ class Streamer(Task):
         period=None,
         queue=None,
         new_process=False,
+        monitor=None,
+        monitor_name="streamer",
+        partitions=None,
+        key=None,
         **kwargs
     ):
+        timer = period or default_period
+        self._loaders = []
+        if partitions is not None:  # One loader per partition, merged here.
+            # Loaders buffer half the hwm and the merged queue the rest, though
+            # every queue holds at least an item.
+            partitions, hwm = list(partitions), hwm or default_hwm
+            loaders_hwm = max(1, hwm // 2 // max(1, len(partitions)))
+            loaders_queue = None if key else new_queue(max(1, hwm // 2), new_process)
+            hwm = max(1, hwm - (loaders_hwm * len(partitions) if key else hwm // 2))
+            self._loaders = [
+                Streamer(
+                    load_batch,
+                    partition,
+                    *args,
+                    hwm=loaders_hwm,
+                    period=period,
+                    queue=loaders_queue,
+                    new_process=new_process,
+                    **kwargs
+                )
+                for partition in partitions
+            ]
+            load_batch = _merged
+            args, kwargs = (self._loaders, key, loaders_queue), {}
+            timer, new_process = Timer(timer, time.time()), False
         self._queue = queue or new_queue(hwm, new_process)
+        self._probe = _Probe(monitor, monitor_name)
         super().__init__(
-            period or default_period,
+            timer,
             self._callback,
             load_batch,
-            self._queue.maxsize,
+            _maxsize(self._queue),
             period,
             args,
             kwargs,
             new_process=new_process,
         )
 
+    def start(self):
+        for loader in self._loaders:
+            loader.start()
+        return super().start()
+
+    def stop(self):
+        for loader in self._loaders:
+            loader.stop()
+        return super().stop()
+
+    def join(self, timeout=None):
+        deadline = _deadline(timeout)
+        super().join(timeout)
+        for loader in self._loaders:
+            loader.join(_remaining(deadline))
+
+    def _spawned(self):
+        yield from super()._spawned()
+        for loader in self._loaders:
+            yield from loader._spawned()
+
     def get(self, *args, **kwargs):
-        return self._queue.get(*args, **kwargs)
+        return self._probe.get(self._queue, *args, **kwargs)
 
     def __iter__(self):
         return self
 
     def __next__(self):
-        obj = self._queue.get()
+        obj = self._probe.get(self._queue)
         if obj is Task.Stop:
             raise StopIteration
         return obj
 
     def _callback(self, load_batch, hwm, period, args, kwargs):
-        for obj in load_batch(hwm, period, *args, **kwargs):
-            self._queue.put(obj)
+        size, stop = 0, False
+        with self._probe.timeit("load"):
+            for obj in load_batch(hwm, period, *args, **kwargs):
+                self._probe.put(self._queue, obj)
+                stop = obj is Task.Stop
+                if stop:
+                    break
+                size += 1
+        self._probe.batch(self._queue, size)
+        if stop:
+            return Task.Stop
+
+
+class Pool:
+    def __init__(self, workers=None, new_process=False):
+        workers = workers or os.cpu_count()
+        self._deques = [deque() for _ in range(workers)]
+        self._items = mt.Semaphore(0)  # One per queued item, plus a stop per worker.
+        self._closed = False
+        self._next = count()
+        self._local = mt.local()
+        self._in_flight = 2 * workers  # Chunks submitted ahead by map and imap.
+        self._calls = [_call] * workers
+        self._conns = self._processes = []
+        if new_process:  # Each thread runs its items in its own process.
+            pipes = [mp.Pipe() for _ in range(workers)]
+            self._conns = [conn for conn, _ in pipes]
+            self._calls = [partial(_call_process, conn) for conn in self._conns]
+            self._processes = [Process(_serve, conn) for _, conn in pipes]
+        self._threads = [Thread(self._work, i) for i in range(workers)]
+
+    def start(self):
+        for worker in self._processes + self._threads:
+            worker.start()
+        return self
+
+    def join(self):  # Handles every item submitted so far.
+        self._closed = True
+        for _ in self._threads:
+            self._items.release()
+        for thread in self._threads:
+            thread.join()
+        for conn in self._conns:
+            conn.send(Task.Stop)
+        for process in self._processes:
+            process.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.join()
+
+    def submit(self, fn, *args, **kwargs):
+        assert not self._closed
+        future = Future()
+        # Items submitted from a worker go to its own deque, others round robin.
+        own = getattr(self._local, "deque", None)
+        if own is None:
+            own = self._deques[next(self._next) % len(self._deques)]
+        own.append((future, fn, args, kwargs))
+        self._items.release()
+        return future
+
+    def map(self, fn, *iterables, chunk_size=1):
+        futures = deque()
+        for chunk in chunks(zip(*iterables), chunk_size):
+            if len(futures) == self._in_flight:
+                yield from futures.popleft().result()
+            futures.append(self.submit(_call_chunk, fn, list(chunk)))
+        while futures:
+            yield from futures.popleft().result()
+
+    def imap_unordered(self, fn, iterable, chunk_size=1):
+        futures = set()
+        for chunk in chunks(((obj,) for obj in iterable), chunk_size):
+            if len(futures) == self._in_flight:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield from future.result()
+            futures.add(self.submit(_call_chunk, fn, list(chunk)))
+        for future in as_completed(futures):
+            yield from future.result()
+
+    def _work(self, index):
+        self._local.deque = own = self._deques[index]
+        call = self._calls[index]
+        while True:
+            self._items.acquire()
+            item = self._take(own)
+            if item is None:
+                return
+            future, fn, args, kwargs = item
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(call(fn, args, kwargs))
+            except Exception as error:
+                future.set_exception(error)
+
+    def _take(self, own):
+        while True:
+            try:
+                return own.pop()  # Newest first, while its data is still hot.
+            except IndexError:
+                pass
+            for other in self._deques:  # Oldest first, likely the biggest ones.
+                try:
+                    return other.popleft()
+                except IndexError:
+                    pass
+            if self._closed:
+                return None
+
+
+class AsyncTask:
+
+    Stop = Task.Stop
+
+    def __init__(self, period_or_timer, callback, *args, **kwargs):
+        self._job = as_timer(period_or_timer), callback, args, kwargs
+        self.__stop = False
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.ensure_future(self._run(*self._job))
+        return self
+
+    async def join(self):
+        await self._task
+
+    def stop(self):
+        self.__stop = True
+        return self
+
+    async def _run(self, timer, callback, args, kwargs):
+        while True:
+            try:
+                await asyncio.sleep(timer.delay)
+                if not timer.is_time:
+                    continue
+                if (
+                    self.__stop
+                    or await _awaited(callback(*args, **kwargs)) is Task.Stop
+                ):
+                    logger.info("Task cleanly stopped")
+                    return
+            except Exception:
+                logger.exception("Error executing task")
+
+
+class AsyncBatcher(AsyncTask):
+    def __init__(
+        self, handle_batch, *args, hwm=None, period=None, queue=None, **kwargs
+    ):
+        self._queue = queue or asyncio.Queue(hwm or default_hwm)
+        super().__init__(
+            period or default_period, self._callback, handle_batch, args, kwargs
+        )
+
+    async def put(self, obj):
+        await self._queue.put(obj)
+
+    def put_nowait(self, obj):
+        self._queue.put_nowait(obj)
+
+    async def join(self):
+        await self._queue.put(Task.Stop)
+        await super().join()
+
+    async def _callback(self, handle_batch, args, kwargs):
+        batch = await _async_dequeue(self._queue, 1)
+        stop = batch[-1] is Task.Stop
+        await _awaited(handle_batch(batch[:-1] if stop else batch, *args, **kwargs))
+        if stop:
+            return Task.Stop
+
+
+class AsyncStreamer(AsyncTask):
+    def __init__(self, load_batch, *args, hwm=None, period=None, queue=None, **kwargs):
+        self._queue = queue or asyncio.Queue(hwm or default_hwm)
+        super().__init__(
+            period or default_period,
+            self._callback,
+            load_batch,
+            self._queue.maxsize,
+            period,
+            args,
+            kwargs,
+        )
+
+    async def get(self):
+        return await self._queue.get()
+
+    def get_nowait(self):
+        return self._queue.get_nowait()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        obj = await self._queue.get()
+        if obj is Task.Stop:
+            raise StopAsyncIteration
+        return obj
+
+    async def _callback(self, load_batch, hwm, period, args, kwargs):
+        batch = load_batch(hwm, period, *args, **kwargs)
+        if not hasattr(batch, "__aiter__"):
+            batch = _as_async_iter(batch)
+        async for obj in batch:
+            await self._queue.put(obj)
             if obj is Task.Stop:
                 return Task.Stop
 
 
-def new_queue(hwm=None, shared=False, pack=1):
+class SharedQueue:  # Must be inherited by the processes, like mp.Queue.
+
+    _stop = 0xFFFFFFFF  # Length header of Task.Stop.
+
+    def __init__(self, maxsize=0, record=None, pack=1, size=None):
+        from multiprocessing.shared_memory import SharedMemory
+
+        self.maxsize = maxsize
+        self._record = record and struct.Struct(record)
+        self._packed = pack > 1
+        if size is None:
+            if self._record and maxsize:
+                size = maxsize * (_header.size + pack * self._record.size)
+            else:
+                size = default_shared_size
+        self._size = size
+        self._shm = SharedMemory(create=True, size=size)
+        self._buf = self._shm.buf
+        self._owner = True
+        self._state = mp.RawArray(ct.c_uint64, 3)  # Read, write offsets and count.
+        self._cond = mp.Condition()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        del state["_buf"]
+        state["_owner"] = False
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._buf = self._shm.buf
+
+    def qsize(self):
+        return self._state[2]
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return 0 < self.maxsize <= self.qsize()
+
+    def put(self, obj, block=True, timeout=None):
+        if obj is Task.Stop:
+            data, length = b"", self._stop
+        else:
+            data = self._encode(obj)
+            length = len(data)
+        need = _header.size + len(data)
+        if need > self._size:
+            raise ValueError("Object of %s bytes doesn't fit in queue" % len(data))
+        state = self._state
+        with self._cond:
+            if not self._cond.wait_for(
+                lambda: not self.full() and state[1] - state[0] + need <= self._size,
+                timeout if block else 0,
+            ):
+                raise Full
+            self._write(state[1], _header.pack(length))
+            self._write(state[1] + _header.size, data)
+            state[1] += need
+            state[2] += 1
+            self._cond.notify_all()
+
+    def put_nowait(self, obj):
+        self.put(obj, False)
+
+    def get(self, block=True, timeout=None):
+        state = self._state
+        with self._cond:
+            if not self._cond.wait_for(lambda: state[2] > 0, timeout if block else 0):
+                raise Empty
+            (length,) = _header.unpack(self._read(state[0], _header.size))
+            if length == self._stop:
+                obj, length = Task.Stop, 0
+            else:
+                obj = self._decode(self._read(state[0] + _header.size, length))
+            state[0] += _header.size + length
+            state[2] -= 1
+            self._cond.notify_all()
+        return obj
+
+    def get_nowait(self):
+        return self.get(False)
+
+    def close(self):
+        self._buf.release()
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+
+    def _encode(self, obj):
+        record = self._record
+        if not record:
+            return memoryview(obj).cast("B")
+        elif self._packed:
+            data = bytearray(record.size * len(obj))
+            for i, values in enumerate(obj):
+                record.pack_into(data, i * record.size, *values)
+            return data
+        else:
+            return record.pack(*obj)
+
+    def _decode(self, data):
+        record = self._record
+        if not record:
+            return bytes(data)
+        elif self._packed:
+            return list(record.iter_unpack(data))
+        else:
+            return record.unpack(data)
+
+    def _write(self, offset, data):
+        start = offset % self._size
+        end = min(start + len(data), self._size)
+        self._buf[start:end] = data[: end - start]
+        self._buf[: len(data) - (end - start)] = data[end - start :]
+
+    def _read(self, offset, length):  # Avoids copies unless wrapping around.
+        start = offset % self._size
+        if start + length <= self._size:
+            return self._buf[start : start + length]
+        return bytes(self._buf[start:]) + bytes(
+            self._buf[: length - (self._size - start)]
+        )
+
+
+class _Probe:
+    # Feeds queue and task metrics into a gcd.monitor.Monitor, if any. Only the
+    # metrics from the current process are seen when using new_process.
+
+    def __init__(self, monitor, name):
+        self._monitor = monitor
+        self._name = name
+        self._last_time = time.monotonic()
+
+    def put(self, queue, obj, *args, **kwargs):
+        if self._monitor is None:
+            return queue.put(obj, *args, **kwargs)
+        try:
+            queue.put_nowait(obj)
+        except Full:
+            with self._monitor.timeit(self._name, "put_block"):
+                queue.put(obj, *args, **kwargs)
+
+    def get(self, queue, *args, **kwargs):
+        if self._monitor is None:
+            return queue.get(*args, **kwargs)
+        try:
+            return queue.get_nowait()
+        except Empty:
+            with self._monitor.timeit(self._name, "get_block"):
+                return queue.get(*args, **kwargs)
+
+    def batch(self, queue, size):
+        monitor, name = self._monitor, self._name
+        if monitor is None:
+            return
+        now = time.monotonic()
+        monitor.stats(name, "depth", full=True).add(queue.qsize())
+        monitor.stats(name, "batch_size", full=True).add(size)
+        monitor.stats(name, "throughput").add(size / max(now - self._last_time, 1e-6))
+        monitor[name, "items"] += size
+        self._last_time = now
+
+    def timeit(self, what):
+        if self._monitor is None:
+            return nullcontext()
+        return self._monitor.timeit(self._name, what)
+
+
+def new_queue(hwm=None, shared=False, pack=1, record=None):
+    maxsize = int((hwm or default_hwm) / pack)
+    if record:  # Struct format or bytes, carried through shared memory.
+        assert shared
+        return SharedQueue(maxsize, None if record is bytes else record, pack)
     queue_class = mp.Queue if shared else Queue
-    return queue_class(int((hwm or default_hwm) / pack))
+    return queue_class(maxsize)
 
 
 def dequeue(queue, at_least=0, at_most=None):
@@ -182,24 +918,122 @@ def dequeue(queue, at_least=0, at_most=None):
         pass
 
 
-def packer(put, size):
+def packer(put, size, typecode=None):
     def wrapper(*obj, flush=False):
         nonlocal pack
         pack.extend(obj)
         if flush or len(pack) >= size:
             put(pack)
-            pack = []
+            pack = new_pack()
 
-    pack = []
+    new_pack = list if typecode is None else partial(array, typecode)
+    pack = new_pack()
     return wrapper
 
 
-def unpacker(get):
+def unpacker(get, typecode=None):
     def wrapper():
-        nonlocal pack
-        if not pack:
-            pack = get()
-        return pack.pop(0)
+        nonlocal pack, i
+        while i == len(pack):
+            pack, i = get(), 0
+            if typecode is not None:  # Items as bytes, array or any buffer.
+                pack = memoryview(pack).cast("B").cast(typecode)
+        i += 1
+        return pack[i - 1]
 
-    pack = None
+    pack, i = (), 0
     return wrapper
+
+
+def _merged(hwm, period, loaders, key, queue):
+    if key:
+        yield from heapq.merge(*loaders, key=key)
+    else:  # Every loader puts into the same queue.
+        stops = len(loaders)
+        while stops:
+            obj = queue.get()
+            if obj is Task.Stop:
+                stops -= 1
+            else:
+                yield obj
+    yield Task.Stop
+
+
+def _crashed(worker):
+    return worker is not None and getattr(worker, "exitcode", 0) not in (0, None)
+
+
+def _deadline(timeout):
+    return None if timeout is None else time.monotonic() + timeout
+
+
+def _remaining(deadline):
+    return None if deadline is None else max(0, deadline - time.monotonic())
+
+
+def _maxsize(queue):  # mp.Queue keeps it private.
+    return queue.maxsize if hasattr(queue, "maxsize") else queue._maxsize
+
+
+def _call(fn, args, kwargs):
+    return fn(*args, **kwargs)
+
+
+def _call_chunk(fn, chunk):
+    return [fn(*args) for args in chunk]
+
+
+def _call_process(conn, fn, args, kwargs):
+    conn.send((fn, args, kwargs))  # Pickles right away, raising any error here.
+    ok, result = conn.recv()
+    if not ok:
+        raise result
+    return result
+
+
+def _serve(conn):
+    while True:
+        call = conn.recv()
+        if call is Task.Stop:
+            return
+        fn, args, kwargs = call
+        try:
+            conn.send((True, fn(*args, **kwargs)))
+        except Exception as error:
+            conn.send((False, error))
+
+
+def _handle_batches(batches, results, handle_batch, args, kwargs):
+    while True:
+        item = batches.get()
+        if item is Task.Stop:
+            logger.info("Batch worker cleanly stopped")
+            return
+        seq, batch = item
+        try:
+            result = True, handle_batch(batch, *args, **kwargs)
+        except Exception as error:
+            logger.exception("Error handling batch")
+            result = False, error
+        if results is not None:
+            results.put((seq, *result))
+
+
+async def _async_dequeue(queue, at_least=0, at_most=None):
+    at_most = at_most or queue.qsize()
+    objs = [await queue.get() for _ in range(at_least)]
+    try:
+        for _ in range(at_most - at_least):
+            objs.append(queue.get_nowait())
+    except asyncio.QueueEmpty:
+        pass
+    return objs
+
+
+async def _awaited(obj):
+    return (await obj) if inspect.isawaitable(obj) else obj
+
+
+async def _as_async_iter(iterable):
+    for obj in iterable:
+        yield obj
@@ -1,10 +1,34 @@
 import time
+import asyncio
+import multiprocessing as mp
 
-from unittest import TestCase, main
+from datetime import timezone
+from unittest import TestCase, main, skipIf
 from unittest.mock import Mock, patch
 
-from gcd.chronos import Timer, LeakyBucket, trunc
-from gcd.work import Task
+from gcd.chronos import (
+    Timer,
+    LeakyBucket,
+    SharedLeakyBucket,
+    trunc,
+    trunc_many,
+    utc,
+    utc_many,
+    iso,
+    iso_many,
+    strptime,
+    strftime,
+    strftime_many,
+    local_many,
+    set_timezone,
+    as_datetime,
+)
+from gcd.work import Task, Thread, Process
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 
 class TestTimer(TestCase):
@@ -24,6 +48,17 @@ class TestTimer(TestCase):
             time.return_value = current_time
             self.assertEqual(timer.is_time, is_time)
 
+    @patch("time.monotonic")
+    @patch("time.time")
+    def test_monotonic(self, time, monotonic):
+        time.return_value, monotonic.return_value = 100, 10
+        timer = Timer(period=5, monotonic=True)
+        self.assertEqual(timer.next_time, 15)
+        time.return_value = 0  # Wall clock jumps backwards.
+        monotonic.return_value = 15
+        self.assertTrue(timer.is_time)
+        self.assertEqual(timer.next_time, 20)
+
 
 class TestTask(TestCase):
     def test(self):
@@ -57,6 +92,60 @@ class TestLeakyBucket(TestCase):
         bucket.wait(2)
         self.assertAlmostEqual(time.time() - t0, 0.1, places=3)
 
+    def test_threads(self):
+        def user():
+            used.extend(bucket.use() for _ in range(100))
+
+        used = []
+        bucket = LeakyBucket(0.1, 10)
+        for thread in [Thread(user).start() for _ in range(10)]:
+            thread.join()
+        self.assertEqual(used.count(True), 10)
+
+    def test_acquire(self):
+        async def acquire():
+            await asyncio.gather(*(bucket.acquire() for _ in range(4)))
+
+        bucket = LeakyBucket(20, 2)
+        t0 = time.time()
+        asyncio.run(acquire())
+        self.assertAlmostEqual(time.time() - t0, 0.1, places=2)
+        self.assertFalse(bucket.use())
+
+    def test_use_after_acquire(self):
+        async def acquire(n):
+            tasks = [asyncio.ensure_future(bucket.acquire()) for _ in range(n)]
+            await asyncio.sleep(0)
+            return tasks
+
+        for bucket in LeakyBucket(20, 2), SharedLeakyBucket(20, 2):
+            loop = asyncio.new_event_loop()
+            try:
+                tasks = loop.run_until_complete(acquire(6))  # 4 booked 0.2s ahead.
+                self.assertEqual([bucket.use() for _ in range(10)], [False] * 10)
+                self.assertEqual(bucket._used, 2)
+                for task in tasks:
+                    task.cancel()
+                loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                time.sleep(0.06)
+                self.assertTrue(bucket.use())  # Cancelled ones gave their room back.
+            finally:
+                loop.close()
+
+    def test_shared(self):
+        def user(bucket, used):
+            for _ in range(100):
+                if bucket.use():
+                    with used.get_lock():
+                        used.value += 1
+
+        used = mp.Value("i", 0)
+        bucket = SharedLeakyBucket(0.1, 10)
+        for process in [Process(user, bucket, used).start() for _ in range(4)]:
+            process.join()
+        self.assertEqual(used.value, 10)
+        self.assertFalse(bucket.use())
+
 
 class TestFunctions(TestCase):
     def test_trunc(self):
@@ -67,6 +156,132 @@ class TestFunctions(TestCase):
         # Because of rounding errors, 8 // 0.4 == 19, not 20 as one would expect.
         self.assertEqual(trunc(8, 0.4), 8)
 
+    def test_utc(self):
+        self.assertEqual(
+            utc("2020-01-02T03:04:05.5Z"), utc(2020, 1, 2, 3, 4, 5, 500000)
+        )
+        self.assertEqual(utc("2020-1-2"), utc(2020, 1, 2))
+        self.assertEqual(utc("03:04:05"), utc(1900, 1, 1, 3, 4, 5))
+        self.assertEqual(utc("03:04:05.25"), utc(1900, 1, 1, 3, 4, 5, 250000))
+        for text in "2020-02-30", "2020-01-01 03:04", "03:04":
+            with self.assertRaisesRegex(ValueError, "does not match format"):
+                utc(text)
+
+    def test_utc_many(self):
+        isos = [
+            "2020-03-08 01:59:59.25",
+            "2020-03-08T02:30:00Z",  # Skipped by DST.
+            "2020-11-01 01:30:00",  # Repeated by DST.
+            "2020-11-01 03:00:00.000001",
+            "2020-1-2",
+        ]
+        set_timezone("America/New_York")
+        try:
+            self.assertEqual(list(utc_many(isos)), [utc(i) for i in isos])
+            self.assertEqual(
+                list(utc_many(iso[:10] for iso in isos)),
+                [utc(iso[:10]) for iso in isos],
+            )
+            self.assertEqual(
+                list(utc_many(["10:00:00", "10:00:01.5"])),
+                [utc("10:00:00"), utc("10:00:01.5")],
+            )
+            with self.assertRaises(ValueError):
+                utc_many(["2020-01-01", "2020-02-30"])
+        finally:
+            set_timezone()
+
+    def test_utc_transitions(self):  # Zone transitions inside a quarter of an hour.
+        for zone, day in (
+            ("America/St_Johns", "2005-10-30"),
+            ("America/Detroit", "1967-06-14"),
+            ("Europe/Amsterdam", "1937-07-01"),
+            ("Asia/Kolkata", "1906-01-01"),
+        ):
+            isos = ["%s 00:%s:00" % (day, m) for m in ("00", "05", "59")]
+            set_timezone(zone)
+            try:
+                stamps = [strptime(i, "%Y-%m-%d %H:%M:%S") for i in isos]
+                self.assertEqual([utc(i) for i in isos], stamps)
+                self.assertEqual(list(utc_many(isos)), stamps)
+                if numpy is not None:
+                    self.assertEqual(utc_many(numpy.array(isos)).tolist(), stamps)
+            finally:
+                set_timezone()
+
+    @skipIf(numpy is None, "numpy not installed")
+    def test_utc_many_numpy(self):
+        isos = ["2020-03-08 01:59:59.250000", "2020-11-01T01:30:00.000001Z"]
+        stamps = utc_many(numpy.array(isos))
+        self.assertIsInstance(stamps, numpy.ndarray)
+        self.assertEqual(stamps.tolist(), [utc(i) for i in isos])
+        self.assertEqual(
+            utc_many(numpy.array(["2020-01-01", "2020-1-2"])).tolist(),
+            [utc("2020-01-01"), utc("2020-1-2")],
+        )
+        with self.assertRaises(ValueError):
+            utc_many(numpy.array(["2020-02-30"]))
+
+    def test_many(self):
+        set_timezone("America/New_York")
+        try:
+            stamps = [
+                utc(2020, 3, 8, 1, 59, 59, 999999),
+                utc(2020, 3, 8, 3),  # After DST starts.
+                utc(2020, 11, 1, 1, 30) + 3600,  # Repeated by DST.
+                0.9999995,
+            ]
+            self.assertEqual(iso_many(stamps), [iso(s) for s in stamps])
+            self.assertEqual(
+                strftime_many(stamps, "%H %Z"), [strftime(s, "%H %Z") for s in stamps]
+            )
+            locals_ = local_many(stamps)
+            self.assertAlmostEqual(locals_[1] - locals_[0], 3600, places=5)
+            self.assertEqual(locals_[2] - stamps[2], -5 * 3600)
+        finally:
+            set_timezone()
+        set_timezone("America/St_Johns")  # Switched at 00:01 until 2011.
+        try:
+            stamps = [utc(2005, 4, 3, 0, 5), utc(2005, 4, 3, 0, 0, 59)]
+            self.assertEqual(iso_many(stamps), [iso(s) for s in stamps])
+            self.assertEqual(
+                list(local_many(stamps)), [s + utc_offset(s) for s in stamps]
+            )
+            if numpy is not None:
+                self.assertEqual(
+                    iso_many(numpy.array(stamps)).tolist(), [iso(s) for s in stamps]
+                )
+                self.assertEqual(
+                    local_many(numpy.array(stamps)).tolist(), list(local_many(stamps))
+                )
+        finally:
+            set_timezone()
+        self.assertEqual(list(trunc_many([7, 8], 2)), [6, 8])
+        self.assertEqual(list(trunc_many([8], 0.4)), [8])
+
+    @skipIf(numpy is None, "numpy not installed")
+    def test_many_numpy(self):
+        set_timezone("America/New_York")
+        try:
+            stamps = numpy.array(
+                [utc(2020, 3, 8, 1, 59, 59, 999999), utc(2020, 3, 8, 3), 0.9999995]
+            )
+            isos = numpy.empty(len(stamps), "U26")
+            self.assertIs(iso_many(stamps, isos), isos)
+            self.assertEqual(isos.tolist(), [iso(s) for s in stamps])
+            self.assertEqual(
+                local_many(stamps).tolist(), list(local_many(list(stamps)))
+            )
+        finally:
+            set_timezone()
+        self.assertEqual(trunc_many(numpy.array([7, 8]), 2).tolist(), [6, 8])
+        self.assertEqual(trunc_many(numpy.array([8]), 0.4).tolist(), [8])
+
+
+def utc_offset(stamp):
+    local = as_datetime(stamp)
+    return (local.replace(tzinfo=timezone.utc).timestamp() - stamp) // 1
+
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,553 @@
+import os
+import sys
+import time
+import asyncio
+
+from array import array
+from unittest import TestCase, main, skipIf
+from unittest.mock import patch
+
+from psycopg2 import ProgrammingError
+from psycopg2.pool import PoolError
+from psycopg2.extensions import (
+    POLL_OK,
+    POLL_READ,
+    TRANSACTION_STATUS_IDLE,
+    TRANSACTION_STATUS_INTRANS,
+)
+
+from gcd.etc import Bundle
+from gcd.monitor import Monitor
+from gcd.store import (
+    Transaction,
+    AsyncTransaction,
+    PgConnectionPool,
+    AsyncPgConnectionPool,
+    PoolTimeout,
+    QueryCache,
+    QueryProfiler,
+    PrestoError,
+    query_presto_cli,
+    execute,
+    aexecute,
+    astream,
+    executemany,
+    copy_rows,
+    named,
+    records,
+    columns,
+)
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+ready, _ = os.pipe()  # Always readable, for asynchronous connections to poll.
+os.write(_, b"x")
+
+
+class FakeConnection:  # Logs what its cursors execute, returning rows.
+    autocommit = False
+    encoding = "UTF8"
+    closed = False
+
+    def __init__(self, rows=(), description=(("a", 23), ("b", 25)), async_=False):
+        self.rows = list(rows)
+        self.description = description
+        self.executed = []
+        self.fail = None  # Statements with this text raise an error.
+        self.info = Bundle(transaction_status=TRANSACTION_STATUS_IDLE)
+        self.async_ = async_
+        self.polls = 0  # Left for the asynchronous query underway to be done.
+
+    def cursor(self, name=None):
+        return FakeCursor(self, name)
+
+    def commit(self):
+        self.executed.append("COMMIT")
+
+    def rollback(self):
+        if self.fail == "ROLLBACK":
+            raise ValueError("ROLLBACK")
+        self.executed.append("ROLLBACK")
+        self.info.transaction_status = TRANSACTION_STATUS_IDLE
+
+    def close(self):
+        self.closed = True
+
+    def poll(self):  # Asynchronous queries are done at their second poll.
+        self.polls = max(0, self.polls - 1)
+        return POLL_READ if self.polls else POLL_OK
+
+    def fileno(self):
+        return ready
+
+
+class FakeCursor:
+    itersize = 2
+
+    def __init__(self, conn, name=None):
+        self.connection = conn
+        self.name = name
+        self.description = None
+        self.fetches = []
+
+    def execute(self, sql, args=None):
+        if self.connection.fail and self.connection.fail in sql:
+            raise ValueError(sql)
+        conn = self.connection
+        if conn.polls:
+            raise ProgrammingError("an asynchronous query is underway")
+        conn.polls = 2 if conn.async_ else 0
+        conn.executed.append((sql, args))
+        self._rows = list(conn.rows)
+        self.description = conn.description
+        self.rowcount = len(conn.rows)
+        if sql.startswith("DECLARE"):
+            conn.declared = list(conn.rows)
+        elif sql.startswith("FETCH"):
+            size = int(sql.split()[1])
+            self._rows, conn.declared = conn.declared[:size], conn.declared[size:]
+
+    def executemany(self, sql, args):
+        for arg in args:
+            self.execute(sql, arg)
+
+    def mogrify(self, sql, args=None):
+        return (sql % tuple(map(repr, args)) if args else sql).encode()
+
+    def copy_expert(self, sql, file, size):
+        chunks = list(iter(lambda: file.read(size), ""))
+        self.connection.executed.append((sql, chunks))
+
+    def fetchmany(self, size):
+        self.fetches.append(size)
+        rows, self._rows = self._rows[:size], self._rows[size:]
+        return rows
+
+    def fetchall(self):
+        return self.fetchmany(len(self._rows))
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+class TestExecute(TestCase):
+    def test_named(self):
+        conn = FakeConnection([(1, "x"), (2, "y"), (3, "z")])
+        cursor = conn.cursor()
+        rows = execute("SELECT a, b FROM t", cursor=cursor, named=True)
+        self.assertEqual(list(rows), [Bundle(a=a, b=b) for a, b in conn.rows])
+        self.assertEqual(cursor.fetches, [2, 2, 2])  # Batches of itersize.
+        self.assertEqual(list(named(cursor, [(4, "w")])), [Bundle(a=4, b="w")])
+
+    def test_stream(self):
+        conn = FakeConnection([(1, "x"), (2, "y"), (3, "z")])
+        with Transaction(conn):
+            cursor = execute("SELECT a, b FROM t", stream=True)
+            self.assertTrue(cursor.name.startswith("gcd_"))
+            self.assertEqual(cursor.fetchall(), conn.rows)
+            rows = list(execute("SELECT a, b FROM t", stream=3, named=True))
+        self.assertEqual([(r.a, r.b) for r in rows], conn.rows)
+        self.assertEqual(type(rows[0]), type(rows[2]))  # Cached namedtuple.
+        cursor = conn.cursor()
+        cursor.execute("SELECT a, b FROM t")
+        self.assertEqual([tuple(r) for r in records(cursor)], conn.rows)
+        rows = list(records(cursor, [(1, 2)]))
+        self.assertEqual((rows[0].a, rows[0].b), (1, 2))
+
+    def test_chunk_size(self):
+        conn = FakeConnection([(7, "r")])
+        sql = "INSERT INTO t %s RETURNING a, b"
+        args = ((i, str(i)) for i in range(5))  # Never listed at once.
+        rows = execute(sql, args, conn.cursor(), values=True, chunk_size=2, named=True)
+        self.assertEqual(rows, [Bundle(a=7, b="r")] * 3)
+        full = "INSERT INTO t VALUES (%s,%s),(%s,%s) RETURNING a, b"
+        self.assertEqual(
+            conn.executed,
+            [
+                (full, [0, "0", 1, "1"]),
+                (full, [2, "2", 3, "3"]),
+                ("INSERT INTO t VALUES (%s,%s) RETURNING a, b", [4, "4"]),
+            ],
+        )
+        args = [(i, str(i)) for i in range(5)]
+        rows = execute(sql, args, conn.cursor(), values=True, chunk_size=2)
+        self.assertEqual(rows, [(7, "r")] * 3)  # Those of every chunk.
+        conn.description = None  # No RETURNING.
+        rows = execute(sql, args, conn.cursor(), values=True, chunk_size=2)
+        self.assertEqual(rows, [])
+
+    def test_defer(self):
+        conn = FakeConnection()
+        with Transaction(conn) as transaction:
+            execute("INSERT 1", defer=True)
+            execute("INSERT %s", (2,), defer=True)
+            execute("SELECT %s", (3,))  # Along with the deferred ones.
+            execute("INSERT %s", [(4,), (5,)], values=True, defer=True)
+            transaction.flush()
+            transaction.flush()  # Nothing left.
+            execute("INSERT 6", defer=True)
+            copy_rows("t", ["a"], [(7,)])  # Flushes first.
+            execute("INSERT 8", defer=True)
+            execute("SELECT 9", stream=True)  # Flushes first.
+            execute("INSERT 10", defer=True)
+        self.assertEqual(
+            [s if type(s) is str else s[0] for s in conn.executed],
+            [
+                "INSERT 1;INSERT 2;SELECT 3",
+                "INSERT VALUES (4),(5)",
+                "INSERT 6",
+                "COPY t (a) FROM STDIN",
+                "INSERT 8",
+                "SELECT 9",
+                "INSERT 10",
+                "COMMIT",
+            ],
+        )
+
+    def test_defer_rollback(self):
+        conn = FakeConnection()
+        conn.fail = "fail"
+        with self.assertLogs("gcd.store", "ERROR"):
+            with self.assertRaises(ValueError):
+                with Transaction(conn):
+                    execute("INSERT 1", defer=True)
+                    execute("SELECT fail()", defer=True)
+        self.assertEqual(conn.executed, ["ROLLBACK"])
+        self.assertIsNone(Transaction.active())
+
+    def test_defer_debug(self):
+        conn = FakeConnection()
+        with self.assertLogs("gcd.store", "DEBUG") as logs:
+            with Transaction(conn):
+                execute("INSERT 1", defer=True)
+                execute("SELECT %s", (2,))
+        self.assertEqual(conn.executed, [("INSERT 1;SELECT 2", None), "COMMIT"])
+        self.assertIn("'args': 'None'", logs.output[0])
+
+    def test_columnar(self):
+        description = ("i", 23), ("x", 701), ("s", 25), ("b", 16), ("n", 20)
+        conn = FakeConnection(
+            [
+                (1, 0.5, "a", True, 1),
+                (2, 1.5, "b", False, 2),
+                (3, 2.5, "c", True, None),
+            ],
+            description,
+        )
+        cols = execute("SELECT", cursor=conn.cursor(), columnar=True)
+        self.assertEqual(list(cols), ["i", "x", "s", "b", "n"])
+        self.assertEqual(cols.i, array("i", [1, 2, 3]))
+        self.assertEqual(cols.x, array("d", [0.5, 1.5, 2.5]))
+        self.assertEqual(cols.s, ["a", "b", "c"])
+        self.assertEqual(cols.b, array("b", [1, 0, 1]))
+        self.assertEqual(cols.n, [1, 2, None])  # NULLs, so a list after all.
+        cursor = execute("SELECT", cursor=conn.cursor())  # Rows fetched elsewhere.
+        self.assertEqual(columns(cursor, [(1, 2, 3, 4, 5)]).i, array("i", [1]))
+        conn.rows = []
+        cols = execute("SELECT", cursor=conn.cursor(), columnar=True)
+        self.assertEqual(
+            cols, dict(i=array("i"), x=array("d"), s=[], b=array("b"), n=array("q"))
+        )
+
+    @skipIf(numpy is None, "numpy not installed")
+    def test_columnar_numpy(self):
+        description = ("i", 23), ("x", 701), ("s", 25), ("b", 16), ("n", 20)
+        conn = FakeConnection(
+            [(1, 0.5, "a", True, 1), (2, 1.5, "b", False, None)], description
+        )
+        cols = execute("SELECT", cursor=conn.cursor(), columnar="numpy")
+        self.assertEqual(
+            [(c.dtype.name, c.tolist()) for c in cols.values()],
+            [
+                ("int32", [1, 2]),
+                ("float64", [0.5, 1.5]),
+                ("object", ["a", "b"]),
+                ("bool", [True, False]),
+                ("object", [1, None]),
+            ],
+        )
+        conn.rows = []
+        cols = execute("SELECT", cursor=conn.cursor(), columnar="numpy")
+        self.assertEqual([len(c) for c in cols.values()], [0] * 5)
+        self.assertEqual(cols.n.dtype.name, "int64")
+
+
+class TestCopyRows(TestCase):
+    def test(self):
+        conn = FakeConnection()
+        rows = [
+            (1, 0.5, "a\tb\\c", None, True, b"\x01\xff"),
+            (2, 1e100, "x\ny", {"k": "v\n"}, False, [1, None]),
+            (3, -1.0, "", ['a"b', "c\\d", None], [[1, 2], [3, 4]], ["{x}", ""]),
+        ]
+        copy_rows("t", ("a", "b", "c", "d", "e", "f"), rows, conn.cursor(), 20)
+        sql, chunks = conn.executed[0]
+        self.assertEqual(sql, "COPY t (a, b, c, d, e, f) FROM STDIN")
+        self.assertEqual(len(chunks), 3)  # A chunk once size is reached.
+        self.assertEqual(
+            "".join(chunks).split("\n"),
+            [
+                "1\t0.5\ta\\tb\\\\c\t\\N\tt\t\\\\x01ff",
+                '2\t1e+100\tx\\ny\t{"k": "v\\\\n"}\tf\t{"1",NULL}',
+                '3\t-1.0\t\t{"a\\\\"b","c\\\\\\\\d",NULL}\t'
+                '{{"1","2"},{"3","4"}}\t{"{x}",""}',
+                "",
+            ],
+        )
+
+
+@patch("psycopg2.connect", FakeConnection)
+class TestAsync(TestCase):
+    def test(self):
+        async def run():
+            async with AsyncTransaction(pool) as transaction:
+                conn = transaction._conn
+                conn.rows = [(1, "x"), (2, "y"), (3, "z")]
+                rows = list(await aexecute("SELECT a, b FROM t", named=True))
+                stream = astream("SELECT a, b FROM t", named=True, itersize=2)
+                records = [record async for record in stream]
+            with self.assertRaises(ValueError):
+                async with AsyncTransaction(pool):
+                    await aexecute("SELECT")
+                    raise ValueError
+            return conn, rows, records
+
+        pool = AsyncPgConnectionPool(max_conns=1)
+        conn, rows, records = asyncio.run(run())
+        self.assertEqual(rows, [Bundle(a=a, b=b) for a, b in conn.rows])
+        self.assertEqual([tuple(r) for r in records], conn.rows)
+        sqls = [s[0] for s in conn.executed]
+        name = sqls[2].split()[1]
+        self.assertEqual(
+            sqls,
+            [
+                "BEGIN",
+                "SELECT a, b FROM t",
+                "DECLARE %s NO SCROLL CURSOR FOR SELECT a, b FROM t" % name,
+                *["FETCH 2 FROM %s" % name] * 3,
+                "COMMIT",
+                "BEGIN",
+                "SELECT",
+                "ROLLBACK",
+            ],
+        )
+
+    def test_pool(self):
+        async def run():
+            conn = await pool.acquire()
+            with self.assertRaises(PoolTimeout):
+                await pool.acquire(timeout=0.01)
+            conn.info.transaction_status = TRANSACTION_STATUS_INTRANS
+            await pool.release(conn)
+            self.assertIs(await pool.acquire(), conn)  # Rolled back and reused.
+            self.assertEqual(conn.executed, [("ROLLBACK", ())])
+            conn.closed = True
+            await pool.release(conn)
+            self.assertIsNot(await pool.acquire(), conn)
+
+        pool = AsyncPgConnectionPool(max_conns=1)
+        asyncio.run(run())
+
+    def test_concurrent(self):  # Tasks in a transaction take turns to query.
+        async def run():
+            async with AsyncTransaction(pool) as transaction:
+                transaction._conn.rows = [(1, "x"), (2, "y")]
+                stream = astream("SELECT a, b FROM t", itersize=1)
+                return await asyncio.gather(
+                    *(aexecute("SELECT %s", (i,), named=True) for i in range(3)),
+                    listed(stream),
+                )
+
+        async def listed(stream):
+            return [row async for row in stream]
+
+        pool = AsyncPgConnectionPool(max_conns=1)
+        *rows, records = asyncio.run(run())
+        named_rows = [Bundle(a=1, b="x"), Bundle(a=2, b="y")]
+        self.assertEqual([list(r) for r in rows], [named_rows] * 3)
+        self.assertEqual(records, [(1, "x"), (2, "y")])
+
+
+@patch("psycopg2.connect", FakeConnection)
+class TestPgConnectionPool(TestCase):
+    def test_prepared(self):
+        pool = PgConnectionPool(prepared=2)
+        with Transaction(pool):
+            conn = Transaction.active()._conn
+            for _ in range(2):
+                execute("SELECT * FROM t WHERE a = %s AND b = %s", (1, 2))
+            executemany("UPDATE t SET a = %s, b = %s", [(1, 2)])
+            execute("SELECT %(x)s, %(y)s, %(x)s, '%%'", {"x": 1, "y": 2})
+            execute("SELECT 1; SELECT 2")  # Not prepared.
+        statements = [s for s in conn.executed if s[0].startswith("SAVEPOINT")]
+        self.assertEqual(
+            [s[0].split(" AS ")[1] for s in statements],
+            [
+                "SELECT * FROM t WHERE a = $1 AND b = $2; RELEASE gcd",
+                "UPDATE t SET a = $1, b = $2; RELEASE gcd",
+                "SELECT $1, $2, $1, '%'; RELEASE gcd",
+            ],
+        )
+        executed = [s for s in conn.executed if s[0].startswith("EXECUTE")]
+        self.assertEqual(
+            [(s[0].partition("(")[2], s[1]) for s in executed],
+            [
+                ("%s, %s)", (1, 2)),
+                ("%s, %s)", (1, 2)),
+                ("%s, %s)", (1, 2)),
+                ("%(x)s, %(y)s)", {"x": 1, "y": 2}),
+            ],
+        )
+        self.assertIn(("SELECT 1; SELECT 2", ()), conn.executed)
+
+    def test_release(self):
+        pool = PgConnectionPool(min_conns=0, max_conns=2, timeout=0)
+        conns = [pool.acquire(), pool.acquire()]
+        with self.assertRaises(PoolTimeout):
+            pool.acquire()
+        conns[0].info.transaction_status = TRANSACTION_STATUS_INTRANS
+        conns[0].fail = "ROLLBACK"
+        pool.release(conns[0])  # Discarded, freeing its slot.
+        self.assertTrue(conns[0].closed)
+        conns[0] = pool.acquire()
+        pool.release(conns[0])
+        conns[0].closed = True  # Dead while idle, replaced in its own slot.
+        conn = pool.acquire()
+        self.assertIsNot(conn, conns[0])
+        self.assertFalse(conn.closed)
+
+    def test_close(self):
+        pool = PgConnectionPool(min_conns=1, max_conns=2)
+        idle, used = pool.acquire(), pool.acquire()
+        pool.release(idle)
+        pool.close()
+        self.assertTrue(idle.closed and used.closed)  # In use ones too.
+        pool.release(used)
+        with self.assertRaises(PoolError):
+            pool.acquire()
+
+
+class TestQueryCache(TestCase):
+    @patch("gcd.store.execute")
+    def test(self, execute):
+        def hit(sql):  # Rows from the first execute only.
+            return cache.execute(sql) == [(1,)]
+
+        execute.side_effect = lambda *args, **kwargs: [(execute.call_count,)]
+        cache = QueryCache(size=3)
+        for sql, tables in (
+            ("SELECT * FROM public.cfg", ["cfg", "public.cfg", "CFG"]),
+            ("SELECT * FROM a, b x, s.c AS y WHERE a.i = b.i", ["a", "b", "s.c"]),
+            ('SELECT * FROM a JOIN "B" ON a.i = b.i', ["a", "b"]),
+        ):
+            for table in tables:
+                execute.reset_mock()
+                cache.invalidate()
+                self.assertTrue(hit(sql))
+                self.assertTrue(hit(sql))  # Cached.
+                cache.invalidate("other")
+                self.assertTrue(hit(sql))
+                cache.invalidate(table)
+                self.assertFalse(hit(sql), (sql, table))
+        for i in range(4):  # The first one is evicted.
+            cache.execute("SELECT %s", (i,), ttl=0 if i == 3 else None)
+        calls = execute.call_count
+        cache.execute("SELECT %s", (1,))
+        cache.execute("SELECT %s", (3,))  # Expired.
+        cache.execute("SELECT %s", (0,))
+        self.assertEqual(execute.call_count, calls + 2)
+
+
+class TestQueryProfiler(TestCase):
+    def tearDown(self):
+        QueryProfiler.uninstall()
+
+    def test(self):
+        conn = FakeConnection([(1, "x"), (2, "y")])
+        cursor = conn.cursor()
+        conn.fail = "fail"
+        profiler = QueryProfiler.install(Monitor(), sample=1, slow=0)
+        with self.assertLogs("gcd.store", "WARNING") as logs:
+            for i in range(3):
+                execute(
+                    "SELECT * FROM t WHERE a = %s AND b = 'x''%s'" % (i, i), (), cursor
+                )
+            execute("INSERT INTO t %s", [(1, 2), (3, 4)], cursor, values=True)
+            with self.assertRaises(ValueError):
+                execute("SELECT fail(1)", (), cursor)
+        self.assertIn("slow_query", logs.output[0])
+        self.assertEqual(len(logs.output), 4)  # Errors aren't timed.
+        dump = profiler.dump()
+        self.assertEqual(dump[-1], ("SELECT fail(?)", {"errors": 1}))  # No time.
+        info = dict(dump)["SELECT * FROM t WHERE a = ? AND b = ?"]
+        self.assertEqual(info["time"]["n"], 3)
+        self.assertEqual(info["rows"]["mean"], 2)
+        self.assertEqual(sum(info["latency"].values()), 3)
+        self.assertIn("INSERT INTO t VALUES (...)", dict(dump))
+        QueryProfiler.install(Monitor(), sample=0)
+        execute("SELECT 1", (), cursor)
+        self.assertEqual(QueryProfiler.instance.dump(), [])
+
+    def test_flush(self):  # Deferred statements are profiled when sent.
+        profiler = QueryProfiler.install(Monitor(), sample=1, slow=10)
+        with Transaction(FakeConnection()) as transaction:
+            execute("INSERT %s", (1,), defer=True)
+            transaction.flush()
+            execute("INSERT %s", (2,), defer=True)
+        self.assertEqual(dict(profiler.dump())["INSERT ?"]["time"]["n"], 2)
+
+
+class TestQueryPrestoCli(TestCase):
+    command = "%s %s" % (
+        sys.executable,
+        os.path.join(os.path.dirname(__file__), "../../benchmarks/fake_presto_cli.py"),
+    )
+
+    def test(self):
+        expected = [{"i": i, "x": i * 0.5, "s": "row %s" % i} for i in range(100)]
+        for prefetch in False, True:  # Lines split across tiny chunks.
+            rows = query_presto_cli(
+                "SELECT LIMIT 100", self.command, prefetch, chunk_size=7
+            )
+            self.assertEqual(list(rows), expected)
+        rows = query_presto_cli("SELECT LIMIT 10", self.command, server="x")
+        self.assertEqual(next(rows), expected[0])
+        rows.close()  # Terminates it.
+        with self.assertRaisesRegex(PrestoError, "Query failed: FAIL"):
+            list(query_presto_cli("FAIL", self.command))
+
+    def test_close(self):  # Terminates presto-cli, even while it's not printing.
+        for kwargs in {}, dict(prefetch=True), dict(partitions=["1", "2"]):
+            rows = query_presto_cli("SELECT SLEEP 10 LIMIT 2", self.command, **kwargs)
+            next(rows)
+            t0 = time.time()
+            rows.close()
+            self.assertLess(time.time() - t0, 2, kwargs)
+
+    def test_partitions(self):
+        done = []
+        query = "SELECT * WHERE {partition} LIMIT 5"
+        partitions = ["p = %s" % i for i in range(6)]
+        rows = query_presto_cli(query, self.command, partitions=partitions, done=done)
+        self.assertEqual(len(list(rows)), 30)
+        self.assertEqual(sorted(done), partitions)
+        done = []
+        rows = query_presto_cli(
+            query, self.command, partitions=["1", "FAIL"], workers=1, done=done
+        )
+        with self.assertRaises(PrestoError):
+            list(rows)
+        self.assertEqual(done, ["1"])  # To resume with the others.
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,48 @@
+import os
 import time
 import queue
+import signal
+import multiprocessing as mp
+import asyncio
+import itertools
 
 from unittest import TestCase, main
 
-from gcd.work import Thread, Task, Batcher, Streamer, dequeue
+from gcd.monitor import Monitor
+from gcd.work import (
+    Thread,
+    Task,
+    Batcher,
+    Streamer,
+    Scheduler,
+    Supervisor,
+    Process,
+    Pool,
+    SharedQueue,
+    AsyncTask,
+    AsyncBatcher,
+    AsyncStreamer,
+    dequeue,
+    new_queue,
+    packer,
+    unpacker,
+)
+
+
+def put_or_crash(batch, results):  # Must be pickleable.
+    if "crash" in batch:
+        os._exit(1)
+    for obj in batch:
+        results.put(obj)
+
+
+def init_process():  # Must be pickleable.
+    os.environ["GCD_INIT"] = "1"
+
+
+def load_range(hwm, period, partition):  # Must be pickleable.
+    yield from range(*partition)
+    yield Streamer.Stop
 
 
 class TestWorkers(TestCase):
@@ -40,6 +79,211 @@ class TestWorkers(TestCase):
         time.sleep(0.11)
         self.assertEqual(batches, [[1], [2, 3]])
 
+    def test_batcher_limits(self):
+        def handle(batch):
+            batches.append(list(batch))
+
+        batches = []
+        batcher = Batcher(handle, period=10, max_batch=2).start()
+        for i in range(5):
+            batcher.put(i)
+        time.sleep(0.05)
+        self.assertEqual(batches, [[0, 1], [2, 3]])
+        batcher.join()
+        self.assertEqual(batches, [[0, 1], [2, 3], [4]])
+
+        batches = []
+        batcher = Batcher(handle, period=10, max_bytes=4).start()
+        for obj in "ab", "c", "de", "f":
+            batcher.put(obj)
+        time.sleep(0.05)
+        self.assertEqual(batches, [["ab", "c", "de"]])
+        batcher.join()
+
+        batches = []
+        batcher = Batcher(handle, period=10, max_age=0.1).start()
+        batcher.put(1)
+        time.sleep(0.05)
+        batcher.put(2)
+        self.assertEqual(batches, [])
+        time.sleep(0.07)
+        self.assertEqual(batches, [[1, 2]])
+        batcher.join()
+
+    def test_batcher_workers(self):
+        batcher = Batcher(
+            sum, period=0.01, max_batch=2, workers=3, results=True, ordered=True
+        ).start()
+        for i in range(10):
+            batcher.put(i)
+        batcher.put("x")
+        batcher.join()
+        self.assertEqual([batcher.get() for _ in range(5)], [1, 5, 9, 13, 17])
+        with self.assertRaises(TypeError):
+            batcher.get()
+        with self.assertRaises(queue.Empty):
+            batcher.get(timeout=0.1)
+        for workers in None, 1:
+            with self.assertRaisesRegex(AssertionError, "needs workers and results"):
+                Batcher(sum, workers=workers).get()
+
+    def test_streamer_partitions(self):
+        for key, new_process in (None, False), (abs, False), (abs, True):
+            streamer = Streamer(
+                load_range,
+                hwm=4,
+                period=0.01,
+                partitions=[(0, 10), (5, 12), (3, 6)],
+                key=key,
+                new_process=new_process,
+            ).start()
+            objs = list(streamer)
+            streamer.join()
+            expected = [*range(0, 10), *range(5, 12), *range(3, 6)]
+            if key:
+                self.assertEqual(objs, sorted(expected))
+            else:
+                self.assertEqual(sorted(objs), sorted(expected))
+        for key in None, abs:
+            streamer = Streamer(load_range, hwm=10, partitions=[(0, 1)] * 2, key=key)
+            loaders = [loader._queue for loader in streamer._loaders]
+            sizes = [q.maxsize for q in [streamer._queue, *set(loaders)]]
+            self.assertEqual(sum(sizes), 10)  # Everything buffered within hwm.
+            streamer = Streamer(load_range, partitions=[], key=key).start()
+            self.assertEqual(list(streamer), [])
+
+    def test_supervisor(self):
+        results = mp.Queue()
+        supervisor = Supervisor(0.01, backoff=0.01).start()
+        batcher = supervisor.watch(
+            Batcher(put_or_crash, results, period=0.01, new_process=True).start()
+        )
+        os.kill(batcher.worker.pid, signal.SIGKILL)
+        time.sleep(0.1)
+        batcher.put(1)
+        self.assertEqual(results.get(timeout=1), 1)
+        pool = supervisor.watch(
+            Batcher(put_or_crash, results, period=0.01, max_batch=1, workers=2).start()
+        )
+        for obj in "crash", "crash", 2, 3:
+            pool.put(obj)
+        self.assertEqual({results.get(timeout=1) for _ in range(2)}, {2, 3})
+        self.assertTrue(supervisor.shutdown(1))
+        self.assertFalse(batcher.is_alive() or pool.is_alive())
+
+    def test_supervisor_deadline(self):
+        supervisor = Supervisor(0.01).start()
+        batcher = supervisor.watch(
+            Batcher(lambda batch: time.sleep(10), period=0.01, new_process=True)
+        ).start()
+        batcher.put(1)
+        time.sleep(0.05)
+        start = time.time()
+        self.assertFalse(supervisor.shutdown(0.1))
+        self.assertLess(time.time() - start, 1)
+        batcher.join(1)
+        self.assertFalse(batcher.is_alive())
+
+    def test_batcher_join_timeout(self):
+        batcher = Batcher(print, hwm=1, period=0.01, new_process=True).start()
+        os.kill(batcher.worker.pid, signal.SIGKILL)
+        batcher.join()  # The dead process leaves the stop in the queue...
+        start = time.time()
+        batcher.join(0.1)  # ...so this one finds it full.
+        self.assertLess(time.time() - start, 1)
+
+    def test_pool(self):
+        def nested(pool):  # Only done if the other worker steals the items.
+            futures = [pool.submit(time.sleep, 0.05) for _ in range(4)]
+            return [future.result() for future in futures]
+
+        with Pool(2) as pool:
+            future = pool.submit(nested, pool)
+            self.assertEqual(future.result(timeout=1), [None] * 4)
+            self.assertEqual(list(pool.map(pow, range(5), [2] * 5)), [0, 1, 4, 9, 16])
+            self.assertEqual(list(pool.map(abs, [], chunk_size=2)), [])
+            objs = pool.imap_unordered(abs, range(-9, 0), chunk_size=4)
+            self.assertEqual(sorted(objs), list(range(1, 10)))
+            for imap in pool.map, pool.imap_unordered:  # Lazily, even if endless.
+                objs = imap(abs, itertools.count(), chunk_size=3)
+                self.assertEqual(len(list(itertools.islice(objs, 10))), 10)
+            with self.assertRaises(ZeroDivisionError):
+                pool.submit(divmod, 1, 0).result()
+
+    def test_pool_processes(self):
+        Process.init = init_process
+        try:
+            pool = Pool(3, new_process=True)
+        finally:
+            Process.init = None
+        with pool:
+            self.assertEqual(pool.submit(os.getenv, "GCD_INIT").result(), "1")
+            objs = list(pool.map(pow, range(10), [2] * 10, chunk_size=3))
+            self.assertEqual(objs, [i**2 for i in range(10)])
+            pids = {pool.submit(os.getpid).result() for _ in range(10)}
+            self.assertNotIn(os.getpid(), pids)
+            with self.assertRaises(TypeError):
+                pool.submit(abs, "x").result()
+            with self.assertRaises(AttributeError):  # Can't pickle it.
+                pool.submit(lambda: 1).result()
+
+    def test_monitor(self):
+        def load(hwm, period):
+            return [1, 2, Streamer.Stop]
+
+        monitor = Monitor()
+        batcher = Batcher(list, hwm=1, period=0.05, monitor=monitor).start()
+        batcher.put(1)
+        batcher.put(2)  # Blocks until the first flush.
+        batcher.join()
+        streamer = Streamer(load, period=0.05, monitor=monitor).start()
+        self.assertEqual(list(streamer), [1, 2])
+        info = monitor.info()
+        self.assertEqual(info["batcher"]["items"], 2)
+        self.assertEqual(info["batcher"]["put_block"]["n"], 1)
+        self.assertGreater(info["batcher"]["put_block"]["mean"], 0.01)
+        self.assertEqual(info["batcher"]["handle"]["n"], 3)
+        self.assertEqual(info["batcher"]["batch_size"]["max"], 1)
+        self.assertEqual(info["streamer"]["items"], 2)
+        self.assertEqual(info["streamer"]["get_block"]["n"], 1)
+        self.assertIn("depth", info["streamer"])
+
+    def test_scheduler(self):
+        def counter(i):
+            counts[i] += 1
+            if counts[i] == 2:
+                return Task.Stop
+
+        def handle(batch):
+            batches.append(list(batch))
+
+        counts = [0] * 100
+        batches = []
+        scheduler = Scheduler().start()
+        tasks = [Task(0.1, counter, i, scheduler=scheduler).start() for i in range(100)]
+        batcher = Batcher(handle, period=0.1, scheduler=scheduler).start()
+        batcher.put(1)
+        time.sleep(0.15)
+        self.assertEqual(counts, [1] * 100)
+        self.assertEqual(batches, [[1]])
+        batcher.put(2)
+        batcher.join()
+        for task in tasks:
+            task.join()
+        self.assertEqual(counts, [2] * 100)
+        self.assertEqual(batches, [[1], [2]])
+
+    def test_scheduler_slow_callback(self):
+        def tick():
+            ticks.append(time.monotonic())
+
+        ticks = []
+        scheduler = Scheduler(workers=2).start()
+        Task(0.05, time.sleep, 0.5, scheduler=scheduler).start()
+        Task(0.05, tick, scheduler=scheduler).start()
+        time.sleep(0.3)
+        self.assertGreaterEqual(len(ticks), 4)  # Not delayed by the sleeping task.
+
     def test_streamer(self):
         def load(hwm, period):
             nonlocal i
@@ -65,7 +309,121 @@ class TestWorkers(TestCase):
         self.assertEqual(list(streamer), [5, 6])
 
 
+class TestAsyncWorkers(TestCase):
+    def test_task(self):
+        async def counter(step):
+            nonlocal count
+            if count == 2:
+                return Task.Stop
+            count += step
+
+        async def run():
+            task = AsyncTask(0.1, counter, 2).start()
+            self.assertEqual(count, 0)
+            await asyncio.sleep(0.11)
+            self.assertEqual(count, 2)
+            await task.join()
+            self.assertEqual(count, 2)
+
+        count = 0
+        asyncio.run(run())
+
+    def test_batcher(self):
+        async def handle(batch):
+            batches.append(list(batch))
+
+        async def run():
+            batcher = AsyncBatcher(handle, hwm=2, period=0.1).start()
+            await batcher.put(1)
+            await asyncio.sleep(0.11)
+            self.assertEqual(batches, [[1]])
+            await batcher.put(2)
+            await batcher.put(3)
+            with self.assertRaises(asyncio.QueueFull):
+                batcher.put_nowait(4)
+            await asyncio.sleep(0.11)
+            self.assertEqual(batches, [[1], [2, 3]])
+            await batcher.join()
+
+        batches = []
+        asyncio.run(run())
+
+    def test_streamer(self):
+        async def load(hwm, period):
+            self.assertEqual(hwm, 2)
+            self.assertEqual(period, 0.1)
+            for obj in batches.pop(0):
+                yield obj
+
+        async def run():
+            streamer = AsyncStreamer(load, hwm=2, period=0.1).start()
+            await asyncio.sleep(0.11)
+            self.assertEqual(await streamer.get(), 1)
+            with self.assertRaises(asyncio.QueueEmpty):
+                streamer.get_nowait()
+            self.assertEqual([obj async for obj in streamer], [2, 3, 4, 5, 6])
+
+        batches = [[1], [2, 3, 4], [5, 6, Streamer.Stop]]
+        asyncio.run(run())
+
+
 class TestQueues(TestCase):
+    def test_shared_queue(self):
+        q = SharedQueue(3, size=24)
+        self.addCleanup(q.close)
+        q.put(b"abcdef")
+        q.put(bytearray(b"ghi"))
+        with self.assertRaises(queue.Full):
+            q.put(b"jklmnopq", timeout=0)  # Not enough space.
+        self.assertEqual(q.get(), b"abcdef")
+        q.put(b"jklmnopq")  # Wraps around.
+        q.put(Task.Stop)
+        self.assertEqual(q.qsize(), 3)
+        with self.assertRaises(queue.Full):
+            q.put_nowait(b"")
+        self.assertEqual(list(dequeue(q)), [b"ghi", b"jklmnopq", Task.Stop])
+        with self.assertRaises(queue.Empty):
+            q.get(timeout=0.01)
+        with self.assertRaises(ValueError):
+            q.put(b"x" * 21)
+
+    def test_shared_queue_records(self):
+        def producer(q):
+            put = packer(q.put, 3)
+            for i in range(10):
+                put((i, i / 2))
+            put(flush=True)
+            q.put(Task.Stop)
+
+        q = new_queue(10, shared=True, pack=3, record="qd")
+        self.addCleanup(q.close)
+        Process(producer, q).start()
+        get = unpacker(q.get)
+        self.assertEqual([get() for _ in range(10)], [(i, i / 2) for i in range(10)])
+        self.assertIs(q.get(), Task.Stop)
+
+    def test_packer(self):
+        q = queue.Queue()
+        put = packer(q.put, 2)
+        put(1)
+        put(2, 3)
+        put(4, flush=True)
+        self.assertEqual(list(dequeue(q)), [[1, 2, 3], [4]])
+        q.put([])  # Empty packs are skipped.
+        q.put([5])
+        get = unpacker(q.get)
+        self.assertEqual(get(), 5)
+
+    def test_packer_array(self):
+        q = SharedQueue()
+        self.addCleanup(q.close)
+        put = packer(q.put, 3, "d")
+        for x in range(5):
+            put(x / 2)
+        put(flush=True)
+        get = unpacker(q.get, "d")
+        self.assertEqual([get() for _ in range(5)], [x / 2 for x in range(5)])
+
     def test_dequeue(self):
         def enqueuer():
             q.put(1)